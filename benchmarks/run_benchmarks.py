@@ -0,0 +1,347 @@
+"""
+Benchmarks of the trisep and collider hot paths, on reproducible inputs.
+
+Every benchmark reports its throughput (events/s, samples/s or calls/s),
+the best wall time of several repeats and the peak memory allocated by
+Python during one extra traced run (tracemalloc).
+Results are written as JSON, and compared with a saved baseline: a
+benchmark whose throughput dropped, or whose peak memory grew, by more
+than the tolerance is flagged as a regression (exit code 1).
+
+e.g. python benchmarks/run_benchmarks.py --save-baseline baseline.json
+     (change some code)
+     python benchmarks/run_benchmarks.py --baseline baseline.json
+
+The collider benchmark uses a synthetic 'mini' tree, written once to
+the work directory, with the branches of the ATLAS open data files.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'stats', 'notebooks'))
+sys.path.insert(0, os.path.join(REPO_DIR, 'collider'))
+
+WORK_DIR = os.path.join(tempfile.gettempdir(), 'trisep_benchmarks')
+
+# a benchmark setup gets the problem size and returns the function to time
+# and the number of events/samples/calls it processes
+Setup = Callable[[int], Tuple[Callable[[], None], int]]
+
+
+def make_mini_tree(path: str, n_events: int, seed: int=0):
+    """write a synthetic ATLAS-like 'mini' tree with 1-3 leptons per event"""
+    import awkward as ak
+    import uproot
+
+    rng = np.random.default_rng(seed)
+    lep_n = rng.choice([1, 2, 3], size=n_events, p=[0.1, 0.8, 0.1]).astype(np.uint32)
+    n_leptons = int(np.sum(lep_n))
+    lep_pt = (rng.exponential(30000., n_leptons) + 5000.).astype(np.float32)
+    lep_eta = rng.normal(0., 1.5, n_leptons).astype(np.float32)
+    lep_phi = rng.uniform(-np.pi, np.pi, n_leptons).astype(np.float32)
+    per_lepton = {
+        'lep_pt': lep_pt,
+        'lep_eta': lep_eta,
+        'lep_phi': lep_phi,
+        'lep_E': (lep_pt * np.cosh(lep_eta)).astype(np.float32),
+        'lep_type': rng.choice([11, 13], size=n_leptons).astype(np.uint32),
+        'lep_charge': rng.choice([-1, 1], size=n_leptons).astype(np.int32),
+    }
+    data = {'lep_n': lep_n}
+    data.update({name: ak.unflatten(values, lep_n) for name, values in per_lepton.items()})
+
+    tmp_path = path + '.tmp'
+    with uproot.recreate(tmp_path) as file:
+        # mktree + extend gives a TTree like the open data files
+        tree = file.mktree('mini', {name: values.type if isinstance(values, ak.Array) else values.dtype
+                                    for name, values in data.items()},
+                           counter_name=lambda counter: 'lep_n_counter')
+        for start in range(0, n_events, 50000):
+            tree.extend({name: values[start:start + 50000] for name, values in data.items()})
+    os.replace(tmp_path, path)
+
+
+def setup_produce_times(n_calls: int):
+    """LifetimeExperiment.produce_times, default counting time (50 events per call)"""
+    from trisep.LifetimeExperiment import LifetimeExperiment
+    experiment = LifetimeExperiment(bypass_wait=True, seed=1)
+    n_events = int(experiment.counting_time / experiment.le_max_time)
+
+    def run():
+        for _ in range(n_calls):
+            experiment.produce_times()
+    return run, n_calls * n_events
+
+
+def setup_produce_times_large(n_events: int):
+    """SimulatedLifetimeExperiment.produce_times with a long counting time"""
+    from trisep.LifetimeExperiment import SimulatedLifetimeExperiment
+    experiment = SimulatedLifetimeExperiment(0.03, 0.01, 0.002, 0.2, seed=1)
+    experiment.set_counting_time(n_events * experiment.le_max_time)
+    return experiment.produce_times, n_events
+
+
+def setup_log_likelihood(n_calls: int, bins=None):
+    """SimulatedLifetimeExperiment.get_log_likelihood of 100000 times, scanning the lifetime"""
+    from trisep.LifetimeExperiment import SimulatedLifetimeExperiment
+    experiment = SimulatedLifetimeExperiment(0.03, 0.01, 0.002, 0.2, seed=1)
+    times = experiment.produce_times_vectorized(100000)
+    experiment.set_binning(bins)
+    experiment.set_data(times)
+    lifetimes = np.linspace(0.02, 0.04, n_calls)
+
+    def run():
+        for lifetime in lifetimes:
+            experiment.set_isotope_lifetime(lifetime)
+            experiment.get_log_likelihood()
+    return run, n_calls
+
+
+def setup_log_likelihood_binned(n_calls: int):
+    """as setup_log_likelihood, with the binned likelihood (100 bins)"""
+    return setup_log_likelihood(n_calls, bins=100)
+
+
+def radioactivity_g_logP() -> Tuple[list, Callable]:
+    """the posterior of the radioactivity_G notebook (3 counters, uniform priors)"""
+    from trisep.RadioactiveSource import RadioactiveSource
+    from trisep.RadiationCounter import SimulatedRadiationCounter
+
+    observed, observed_control, observed_calib = 6, 5, 826
+    sim_calib_detector = SimulatedRadiationCounter()
+    sim_calib_detector.insert_known_source(RadioactiveSource(30.))
+    sim_calib_detector.set_counting_time(30.)
+    sim_control_detector = SimulatedRadiationCounter()
+    sim_control_detector.set_counting_time(30.)
+    simulated_source = RadioactiveSource(0.6)
+    sim_detector = SimulatedRadiationCounter()
+    sim_detector.set_counting_time(10)
+    sim_detector.insert_known_source(simulated_source)
+
+    def logP(params):
+        simulated_source.set_activity(params['a'])
+        sim_detector.set_background(params['b'])
+        sim_detector.set_efficiency(params['eps'])
+        sim_control_detector.set_background(params['b'])
+        sim_calib_detector.set_background(params['b'])
+        sim_calib_detector.set_efficiency(params['eps'])
+        return (np.log(sim_detector.get_likelihood(observed)) +
+                np.log(sim_control_detector.get_likelihood(observed_control)) +
+                np.log(sim_calib_detector.get_likelihood(observed_calib)))
+
+    parameters = [
+        {'name': 'a', 'start': 0.4, 'step': 0.1, 'min': 0.02, 'max': 1.2},
+        {'name': 'b', 'start': 0.2, 'step': 0.1, 'min': 0.04, 'max': 0.4},
+        {'name': 'eps', 'start': 0.9, 'step': 0.05, 'min': 0., 'max': 1.0},
+    ]
+    return parameters, logP
+
+
+def nue_t2k_logP() -> Tuple[list, Callable]:
+    """the posterior of the nueT2K notebook (Poisson counts, Gaussian systematics)"""
+    from scipy import stats
+
+    nue_sys, nuepi_sys, nuebar_sys = 0.088, 0.184, 0.071
+    nue_obs, nuepi_obs, nuebar_obs = 74, 15, 7
+
+    def logP(pars):
+        sdcp = pars['sdcp']
+        if pars['mo'] < 0:
+            expected = [54.2 - 10.7 * sdcp, 5.2 - 1.0 * sdcp, 9.8 + 1.2 * sdcp]
+        else:
+            expected = [61.7 - 11.8 * sdcp, 5.9 - 1.0 * sdcp, 9.0 + 1.0 * sdcp]
+        scales = [pars['scale_nue'], pars['scale_nuepi'], pars['scale_nuebar']]
+        log_likelihood = sum(stats.poisson.logpmf(obs, exp * scale) for obs, exp, scale in
+                             zip([nue_obs, nuepi_obs, nuebar_obs], expected, scales))
+        log_prior = -0.5 * sum(((scale - 1.) / sys) ** 2 for scale, sys in
+                               zip(scales, [nue_sys, nuepi_sys, nuebar_sys]))
+        return log_likelihood + log_prior
+
+    parameters = [
+        {'name': 'mo', 'start': 0.5, 'step': 0.2, 'min': -1., 'max': 1.},
+        {'name': 'sdcp', 'start': 0., 'step': 0.1, 'min': -1., 'max': 1.},
+        {'name': 'scale_nue', 'start': 1., 'step': 0.3 * nue_sys, 'min': 0., 'max': 10.},
+        {'name': 'scale_nuepi', 'start': 1., 'step': 0.3 * nuepi_sys, 'min': 0., 'max': 10.},
+        {'name': 'scale_nuebar', 'start': 1., 'step': 0.3 * nuebar_sys, 'min': 0., 'max': 10.},
+    ]
+    return parameters, logP
+
+
+def setup_chain(n_samples: int, posterior: Callable):
+    """MarkovChain.get_chain on one of the notebook posteriors"""
+    from trisep.MarkovChain import MarkovChain
+    parameters, logP = posterior()
+
+    def run():
+        # a new chain with the same seed each time, so every repeat follows the same random walk
+        mcmc = MarkovChain(parameters, logP, seed=1)
+        mcmc.show_progress = False
+        mcmc.get_chain(n_samples)
+    return run, n_samples
+
+
+def setup_chain_radioactivity_g(n_samples: int):
+    return setup_chain(n_samples, radioactivity_g_logP)
+
+
+def setup_chain_nue_t2k(n_samples: int):
+    return setup_chain(n_samples, nue_t2k_logP)
+
+
+def setup_produce_count(n_calls: int):
+    """RadiationCounter.produce_count with the lab source"""
+    from trisep.RadiationCounter import RadiationCounter
+    counter = RadiationCounter(bypass_wait=True)
+    counter.insert_lab_source()
+
+    def run():
+        for _ in range(n_calls):
+            counter.produce_count()
+    return run, n_calls
+
+
+def setup_collider_chain(n_events: int):
+    """open_file -> make_cuts -> Z reconstruction -> plot_histogram, on a synthetic mini tree"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import cuts
+    import file_handler
+    import kinematics
+    from collision import BRANCH_NAMES
+    from plotter import plot_histogram
+
+    path = os.path.join(WORK_DIR, f'mini_{n_events}.root')
+    if not os.path.exists(path):
+        make_mini_tree(path, n_events)
+    plot_path = os.path.join(WORK_DIR, 'reco_z_mass.png')
+
+    def run():
+        data = file_handler.open_file(path, BRANCH_NAMES, use_cache=False)
+        data = cuts.make_cuts(data, particle_id=13)
+        z_candidate = kinematics.z_kinematics(
+            *(kinematics.leading_pair(data[name] / 1000 if name in ('lep_pt', 'lep_E') else data[name])
+              for name in ['lep_pt', 'lep_eta', 'lep_phi', 'lep_E']))
+        plot_histogram(z_candidate['mass'], 30, (40, 140), save_name=plot_path)
+    return run, n_events
+
+
+# name: (setup, unit, full size, quick size)
+BENCHMARKS: Dict[str, Tuple[Setup, str, int, int]] = {
+    'lifetime_produce_times': (setup_produce_times, 'events/s', 2000, 200),
+    'lifetime_produce_times_large': (setup_produce_times_large, 'events/s', 1000000, 100000),
+    'lifetime_log_likelihood': (setup_log_likelihood, 'calls/s', 100, 10),
+    'lifetime_log_likelihood_binned': (setup_log_likelihood_binned, 'calls/s', 1000, 100),
+    'chain_radioactivity_G': (setup_chain_radioactivity_g, 'samples/s', 10000, 1000),
+    'chain_nueT2K': (setup_chain_nue_t2k, 'samples/s', 10000, 1000),
+    'counter_produce_count': (setup_produce_count, 'calls/s', 10000, 1000),
+    'collider_chain': (setup_collider_chain, 'events/s', 1000000, 100000),
+}
+
+
+def measure(setup: Setup, size: int, repeat: int) -> Dict[str, float]:
+    """best time of repeat runs, then the peak traced memory of one more run"""
+    run, n_units = setup(size)
+    run()  # warm up (imports, caches, compiled kernels)
+    times = []
+    for _ in range(repeat):
+        tick = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - tick)
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = min(times)
+    return {'size': n_units, 'seconds': best, 'throughput': n_units / best,
+            'peak_memory_mb': peak / 1024**2}
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> list:
+    """print each benchmark against the baseline, return the names that regressed"""
+    regressions = []
+    print(f'{"benchmark":>32} {"throughput":>14} {"baseline":>14} {"ratio":>7} '
+          f'{"memory MB":>10} {"baseline":>9}')
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None or reference['size'] != result['size']:
+            print(f'{name:>32} {result["throughput"]:>14.4g} {"-":>14} {"-":>7} '
+                  f'{result["peak_memory_mb"]:>10.1f} {"-":>9}')
+            continue
+        ratio = result['throughput'] / reference['throughput']
+        slower = ratio < 1. - tolerance
+        bigger = result['peak_memory_mb'] > (1. + tolerance) * reference['peak_memory_mb'] + 1.
+        flag = '  REGRESSION' if slower or bigger else ''
+        print(f'{name:>32} {result["throughput"]:>14.4g} {reference["throughput"]:>14.4g} '
+              f'{ratio:>7.2f} {result["peak_memory_mb"]:>10.1f} '
+              f'{reference["peak_memory_mb"]:>9.1f}{flag}')
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--quick', action='store_true', help='smaller problem sizes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--save-baseline', help='also write the results here, as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional loss of throughput (and growth of memory)')
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmarks {unknown}, choose from {list(BENCHMARKS)}')
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    results = {}
+    for name in names:
+        setup, unit, full_size, quick_size = BENCHMARKS[name]
+        print(f'running {name}...')
+        results[name] = measure(setup, quick_size if args.quick else full_size, args.repeat)
+        results[name]['unit'] = unit
+        print(f'{name}: {results[name]["throughput"]:.4g} {unit}, '
+              f'peak memory {results[name]["peak_memory_mb"]:.1f} MB')
+
+    report = {
+        'metadata': {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'quick': args.quick,
+        },
+        'benchmarks': results,
+    }
+    for path in [args.output, args.save_baseline]:
+        if path is not None:
+            with open(path, 'w') as file:
+                json.dump(report, file, indent=2)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['benchmarks']
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
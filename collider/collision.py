@@ -1,11 +1,23 @@
-"""Main module for the collider physics tutorial at TRISEP 2022"""
+"""
+Main module for the collider physics tutorial at TRISEP 2022
+
+Run the Z analysis over several files, with chunks spread over a process pool:
+    python collision.py DataMuons.root DataEgamma.root --workers 8
+or with explicit PDG IDs: python collision.py my_muons.root:13
+"""
+
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
 
 # physics
+import awkward as ak
 import numpy as np
-import vector
 import file_handler
 import cuts
-from plotter import plot_histogram
+import kinematics
+from plotter import HistogramBook
 
 # constants and such
 BRANCH_NAMES = [  # things we'll need from file (use None to get everything)
@@ -16,133 +28,301 @@ BRANCH_NAMES = [  # things we'll need from file (use None to get everything)
     'lep_n',
     'lep_charge',
     'lep_type']
-SAMPLE_SIZE = 100000  # use None to get the whole dataset
+SAMPLE_SIZE = 100000  # per file, use None to get the whole dataset
+STEP_SIZE = 50000  # events per chunk, bounds the memory used by each worker
 
-FILE_NAME = 'DataMuons.root'
-PARTICLE_ID = {
+PARTICLE_IDS = {
     # "file_name": PDG ID,
     "DataMuons.root": 13,
     "DataEgamma.root": 11,
-}[FILE_NAME]
-
-# open file, get data
-data = file_handler.open_file(
-    FILE_NAME, branches=BRANCH_NAMES, sample_size=SAMPLE_SIZE)
-print(len(data), 'events to start')
-
-# make some pre-cut histograms
-plot_histogram(
-    data['lep_pt'] / 1000, n_bins=25, range_tuple=(0, 100),
-    xlabel="pT [GeV]", ylabel="counts", title="Lepton pT before cuts",
-    save_name="lep_pt_without_cuts.png")
-plot_histogram(
-    data['lep_n'], n_bins=3, range_tuple=(1, 4),
-    xlabel="lepton number", ylabel="counts", title="Lepton number before cuts",
-    save_name="lep_n_before_cuts.png")
-# 2nd one justifies cutting on exactly two -- only lose 85 events
-
-# make cuts (2 leptons, same type opposite sign, pt>25GeV)
-data = cuts.make_cuts(data, particle_id=PARTICLE_ID)
-print(len(data), 'events left after cuts')
-
-# get data in pretty variables
-lep_pt = data['lep_pt'] / 1000  # to convert MeV to GeV
-lep_eta = data['lep_eta']
-lep_phi = data['lep_phi']
-lep_E = data['lep_E'] / 1000  # MeV --> GeV
-lep_n = data['lep_n']
-
-# plot combined lepton properties after cuts
-plot_histogram(
-    lep_pt, n_bins=25, range_tuple=(0, 100),
-    xlabel="lepton pT", ylabel="counts", title="Lepton pT after cuts",
-    save_name="lep_pt.png")
-plot_histogram(
-    lep_eta, n_bins=25, range_tuple=(0, 4),
-    xlabel="lepton eta", ylabel="counts", title="Lepton eta after cuts",
-    save_name="lep_eta.png")
-plot_histogram(
-    lep_phi, n_bins=25, range_tuple=(0, np.pi),
-    xlabel="lepton phi", ylabel="counts", title="Lepton phi after cuts",
-    save_name="lep_phi.png")
-plot_histogram(
-    lep_E, n_bins=25, range_tuple=(0, 100),
-    xlabel="lepton E", ylabel="counts", title="Lepton E after cuts",
-    save_name="lep_E.png")
-
-# and individual properties
-plot_histogram(
-    lep_pt[:, 0], n_bins=25, range_tuple=(0, 100),
-    xlabel="leading lepton pT", ylabel="counts",
-    title="Leading lepton pT after cuts",
-    save_name="lep_0_pt.png")
-plot_histogram(
-    lep_eta[:, 0], n_bins=25, range_tuple=(0, 4),
-    xlabel="leading lepton eta", ylabel="counts",
-    title="Leading lepton eta after cuts",
-    save_name="lep_0_eta.png")
-plot_histogram(
-    lep_phi[:, 0], n_bins=25, range_tuple=(0, np.pi),
-    xlabel="leading lepton phi", ylabel="counts",
-    title="Leading lepton phi after cuts",
-    save_name="lep_0_phi.png")
-plot_histogram(
-    lep_E[:, 0], n_bins=25, range_tuple=(0, 100),
-    xlabel="leading lepton E", ylabel="counts",
-    title="Leading lepton E after cuts",
-    save_name="lep_0_E.png")
-
-plot_histogram(
-    lep_pt[:, 1], n_bins=25, range_tuple=(0, 100),
-    xlabel="sub-leading lepton pT", ylabel="counts",
-    title="sub-leading lepton pT after cuts",
-    save_name="lep_1_pt.png")
-plot_histogram(
-    lep_eta[:, 1], n_bins=25, range_tuple=(0, 4),
-    xlabel="sub-leading lepton eta", ylabel="counts",
-    title="sub-leading lepton eta after cuts",
-    save_name="lep_1_eta.png")
-plot_histogram(
-    lep_phi[:, 1], n_bins=25, range_tuple=(0, np.pi),
-    xlabel="sub-leading lepton phi", ylabel="counts",
-    title="sub-leading lepton phi after cuts",
-    save_name="lep_1_phi.png")
-plot_histogram(
-    lep_E[:, 1], n_bins=25, range_tuple=(0, 100),
-    xlabel="sub-leading lepton E", ylabel="counts",
-    title="sub-leading lepton E after cuts",
-    save_name="lep_1_E.png")
-
-# make vectors, construct Z candidates
-lepton_vectors = vector.zip({
-    'pt': lep_pt, 'eta': lep_eta, 'phi': lep_phi, 'E': lep_E})
-lead_lepton = lepton_vectors[:, 0]
-next_lepton = lepton_vectors[:, 1]
-z_candidate = lead_lepton + next_lepton
-
-# plot reconstructed Z properties
-plot_histogram(
-    z_candidate.mass, n_bins=100, range_tuple=(50, 150),
-    xlabel="reconstructed Z mass", ylabel="counts",
-    title="reconstructed Z mass",
-    save_name="reco_z_mass.png")
-plot_histogram(
-    z_candidate.pt, n_bins=25, range_tuple=(0, 100),
-    xlabel="reconstructed Z pt", ylabel="counts",
-    title="reconstructed Z pt",
-    save_name="reco_z_pt.png")
-plot_histogram(
-    z_candidate.eta, n_bins=25, range_tuple=(0, 4),
-    xlabel="reconstructed Z eta", ylabel="counts",
-    title="reconstructed Z eta",
-    save_name="reco_z_eta.png")
-plot_histogram(
-    z_candidate.phi, n_bins=25, range_tuple=(0, np.pi),
-    xlabel="reconstructed Z phi", ylabel="counts",
-    title="reconstructed Z phi",
-    save_name="reco_z_phi.png")
-plot_histogram(
-    z_candidate.E, n_bins=25, range_tuple=(0, 100),
-    xlabel="reconstructed Z E", ylabel="counts",
-    title="reconstructed Z E",
-    save_name="reco_z_E.png")
+}
+STAGES = ['read', 'cuts', 'reco', 'fill']
+
+
+def book_histograms() -> HistogramBook:
+    """declare all histograms of the analysis"""
+    histograms = HistogramBook()
+    # pre-cut histograms
+    histograms.book(
+        'lep_pt_without_cuts', n_bins=25, range_tuple=(0, 100),
+        xlabel="pT [GeV]", ylabel="counts", title="Lepton pT before cuts",
+        save_name="lep_pt_without_cuts.png")
+    histograms.book(
+        'lep_n_before_cuts', n_bins=3, range_tuple=(1, 4),
+        xlabel="lepton number", ylabel="counts", title="Lepton number before cuts",
+        save_name="lep_n_before_cuts.png")
+    # 2nd one justifies cutting on exactly two -- only lose 85 events
+
+    # combined lepton properties after cuts
+    histograms.book(
+        'lep_pt', n_bins=25, range_tuple=(0, 100),
+        xlabel="lepton pT", ylabel="counts", title="Lepton pT after cuts",
+        save_name="lep_pt.png")
+    histograms.book(
+        'lep_eta', n_bins=25, range_tuple=(0, 4),
+        xlabel="lepton eta", ylabel="counts", title="Lepton eta after cuts",
+        save_name="lep_eta.png")
+    histograms.book(
+        'lep_phi', n_bins=25, range_tuple=(0, np.pi),
+        xlabel="lepton phi", ylabel="counts", title="Lepton phi after cuts",
+        save_name="lep_phi.png")
+    histograms.book(
+        'lep_E', n_bins=25, range_tuple=(0, 100),
+        xlabel="lepton E", ylabel="counts", title="Lepton E after cuts",
+        save_name="lep_E.png")
+
+    # and individual properties
+    histograms.book(
+        'lep_0_pt', n_bins=25, range_tuple=(0, 100),
+        xlabel="leading lepton pT", ylabel="counts",
+        title="Leading lepton pT after cuts",
+        save_name="lep_0_pt.png")
+    histograms.book(
+        'lep_0_eta', n_bins=25, range_tuple=(0, 4),
+        xlabel="leading lepton eta", ylabel="counts",
+        title="Leading lepton eta after cuts",
+        save_name="lep_0_eta.png")
+    histograms.book(
+        'lep_0_phi', n_bins=25, range_tuple=(0, np.pi),
+        xlabel="leading lepton phi", ylabel="counts",
+        title="Leading lepton phi after cuts",
+        save_name="lep_0_phi.png")
+    histograms.book(
+        'lep_0_E', n_bins=25, range_tuple=(0, 100),
+        xlabel="leading lepton E", ylabel="counts",
+        title="Leading lepton E after cuts",
+        save_name="lep_0_E.png")
+
+    histograms.book(
+        'lep_1_pt', n_bins=25, range_tuple=(0, 100),
+        xlabel="sub-leading lepton pT", ylabel="counts",
+        title="sub-leading lepton pT after cuts",
+        save_name="lep_1_pt.png")
+    histograms.book(
+        'lep_1_eta', n_bins=25, range_tuple=(0, 4),
+        xlabel="sub-leading lepton eta", ylabel="counts",
+        title="sub-leading lepton eta after cuts",
+        save_name="lep_1_eta.png")
+    histograms.book(
+        'lep_1_phi', n_bins=25, range_tuple=(0, np.pi),
+        xlabel="sub-leading lepton phi", ylabel="counts",
+        title="sub-leading lepton phi after cuts",
+        save_name="lep_1_phi.png")
+    histograms.book(
+        'lep_1_E', n_bins=25, range_tuple=(0, 100),
+        xlabel="sub-leading lepton E", ylabel="counts",
+        title="sub-leading lepton E after cuts",
+        save_name="lep_1_E.png")
+
+    # reconstructed Z properties
+    histograms.book(
+        'reco_z_mass', n_bins=100, range_tuple=(50, 150),
+        xlabel="reconstructed Z mass", ylabel="counts",
+        title="reconstructed Z mass",
+        save_name="reco_z_mass.png")
+    histograms.book(
+        'reco_z_pt', n_bins=25, range_tuple=(0, 100),
+        xlabel="reconstructed Z pt", ylabel="counts",
+        title="reconstructed Z pt",
+        save_name="reco_z_pt.png")
+    histograms.book(
+        'reco_z_eta', n_bins=25, range_tuple=(0, 4),
+        xlabel="reconstructed Z eta", ylabel="counts",
+        title="reconstructed Z eta",
+        save_name="reco_z_eta.png")
+    histograms.book(
+        'reco_z_phi', n_bins=25, range_tuple=(0, np.pi),
+        xlabel="reconstructed Z phi", ylabel="counts",
+        title="reconstructed Z phi",
+        save_name="reco_z_phi.png")
+    histograms.book(
+        'reco_z_E', n_bins=25, range_tuple=(0, 100),
+        xlabel="reconstructed Z E", ylabel="counts",
+        title="reconstructed Z E",
+        save_name="reco_z_E.png")
+
+    return histograms
+
+
+def analyse_chunk(data: ak.Array,
+                  particle_id: int,
+                  histograms: HistogramBook,
+                  timings: Dict[str, float],
+                  cut_flow: Dict[str, int]) -> int:
+    """
+    Cut one chunk of events, build Z candidates and fill the histograms.
+    Adds the time spent per stage to timings and the events passing each cut
+    to cut_flow, returns the number of selected events.
+    """
+    tick = time.perf_counter()
+    # fill pre-cut histograms
+    histograms.fill('lep_pt_without_cuts', data['lep_pt'] / 1000)
+    histograms.fill('lep_n_before_cuts', data['lep_n'])
+
+    tock = time.perf_counter()
+    timings['fill'] += tock - tick
+
+    # make cuts (2 leptons, same type opposite sign, pt>25GeV)
+    data = cuts.make_cuts(data, particle_id=particle_id, cut_flow=cut_flow)
+    tick = time.perf_counter()
+    timings['cuts'] += tick - tock
+
+    # get data in pretty variables
+    lep_pt = data['lep_pt'] / 1000  # to convert MeV to GeV
+    lep_eta = data['lep_eta']
+    lep_phi = data['lep_phi']
+    lep_E = data['lep_E'] / 1000  # MeV --> GeV
+    lep_n = data['lep_n']
+
+    # fill combined lepton properties after cuts
+    histograms.fill('lep_pt', lep_pt)
+    histograms.fill('lep_eta', lep_eta)
+    histograms.fill('lep_phi', lep_phi)
+    histograms.fill('lep_E', lep_E)
+
+    # and individual properties
+    histograms.fill('lep_0_pt', lep_pt[:, 0])
+    histograms.fill('lep_0_eta', lep_eta[:, 0])
+    histograms.fill('lep_0_phi', lep_phi[:, 0])
+    histograms.fill('lep_0_E', lep_E[:, 0])
+
+    histograms.fill('lep_1_pt', lep_pt[:, 1])
+    histograms.fill('lep_1_eta', lep_eta[:, 1])
+    histograms.fill('lep_1_phi', lep_phi[:, 1])
+    histograms.fill('lep_1_E', lep_E[:, 1])
+
+    tock = time.perf_counter()
+    timings['fill'] += tock - tick
+
+    # construct Z candidates from the two leptons, all observables in one pass
+    z_candidate = kinematics.z_kinematics(
+        kinematics.leading_pair(lep_pt), kinematics.leading_pair(lep_eta),
+        kinematics.leading_pair(lep_phi), kinematics.leading_pair(lep_E))
+    z_mass, z_pt, z_eta = z_candidate['mass'], z_candidate['pt'], z_candidate['eta']
+    z_phi, z_E = z_candidate['phi'], z_candidate['E']
+    tick = time.perf_counter()
+    timings['reco'] += tick - tock
+
+    # fill reconstructed Z properties
+    histograms.fill('reco_z_mass', z_mass)
+    histograms.fill('reco_z_pt', z_pt)
+    histograms.fill('reco_z_eta', z_eta)
+    histograms.fill('reco_z_phi', z_phi)
+    histograms.fill('reco_z_E', z_E)
+    timings['fill'] += time.perf_counter() - tick
+    return len(data)
+
+
+def process_chunk(filename: str,
+                  particle_id: int,
+                  entry_start: int,
+                  entry_stop: int,
+                  lazy: bool=False) -> Tuple[HistogramBook, Dict[str, float], Dict[str, int]]:
+    """
+    Worker job: read one chunk of a file and analyse it.
+    With lazy=True branches are read as they are used (see file_handler.LazyEvents),
+    so their read time is counted in the stage that first uses them.
+    Returns the partial histograms, stage timings and cut flow.
+    """
+    timings = dict.fromkeys(STAGES, 0.)
+    cut_flow = {}
+    histograms = book_histograms()
+    tick = time.perf_counter()
+    data = file_handler.open_file(filename, branches=BRANCH_NAMES,
+                                  sample_size=entry_stop - entry_start,
+                                  entry_start=entry_start, lazy=lazy)
+    timings['read'] += time.perf_counter() - tick
+    analyse_chunk(data, particle_id, histograms, timings, cut_flow)
+    return histograms, timings, cut_flow
+
+
+def run_analysis(files: Dict[str, int],
+                 n_workers: int=None,
+                 step_size: int=STEP_SIZE,
+                 sample_size: int=SAMPLE_SIZE,
+                 lazy: bool=False) -> HistogramBook:
+    """
+    Run the analysis over several files and merge the histograms.
+
+    files: {file name: PDG ID of its leptons}, e.g. PARTICLE_IDS
+    n_workers: number of worker processes, None for one per core
+    step_size: events per chunk (one job per chunk)
+    sample_size: events to use from each file, None for all of them
+    lazy: read each branch only when needed, and after the cuts only the
+          baskets holding selected events
+    """
+    start_time = time.perf_counter()
+    jobs = []
+    for filename, particle_id in files.items():
+        n_entries = file_handler.get_num_entries(filename)
+        if sample_size is not None:
+            n_entries = min(n_entries, sample_size)
+        for entry_start in range(0, n_entries, step_size):
+            entry_stop = min(entry_start + step_size, n_entries)
+            jobs.append((filename, particle_id, entry_start, entry_stop, lazy))
+
+    # fan the chunks out, then reduce the partial results
+    histograms = book_histograms()
+    timings = dict.fromkeys(STAGES, 0.)
+    cut_flow = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for chunk_histograms, chunk_timings, chunk_cut_flow in \
+                executor.map(process_chunk, *zip(*jobs)):
+            histograms += chunk_histograms
+            for stage in STAGES:
+                timings[stage] += chunk_timings[stage]
+            for name, n_pass in chunk_cut_flow.items():
+                cut_flow[name] = cut_flow.get(name, 0) + n_pass
+    wall_time = time.perf_counter() - start_time
+
+    cuts.print_cut_flow(cut_flow)
+    print_throughput(timings, cut_flow.get('all events', 0), wall_time)
+    return histograms
+
+
+def print_throughput(timings: Dict[str, float], n_events: int, wall_time: float):
+    """events/s per stage (per worker, from the summed stage times) and overall"""
+    for stage in STAGES:
+        rate = n_events / timings[stage] if timings[stage] > 0 else float('inf')
+        print(f'{stage:>6}: {timings[stage]:8.3f} s total, {rate:12.0f} events/s per worker')
+    print(f' total: {wall_time:8.3f} s wall, {n_events / wall_time:12.0f} events/s')
+
+
+def parse_files(file_args: List[str]) -> Dict[str, int]:
+    """'name.root' or 'name.root:PDG' --> {name: PDG ID}"""
+    files = {}
+    for file_arg in file_args:
+        filename, _, particle_id = file_arg.partition(':')
+        if particle_id:
+            files[filename] = int(particle_id)
+        else:
+            files[filename] = PARTICLE_IDS[filename]
+    return files
+
+
+def main():
+    """command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('files', nargs='*', default=['DataMuons.root'],
+                        help='files to process, as name.root or name.root:PDG')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('--step-size', type=int, default=STEP_SIZE,
+                        help='events per chunk')
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE,
+                        help='events per file (default: %(default)s, 0 for all)')
+    parser.add_argument('--lazy', action='store_true',
+                        help='read branches only when used')
+    args = parser.parse_args()
+
+    histograms = run_analysis(parse_files(args.files), n_workers=args.workers,
+                              step_size=args.step_size,
+                              sample_size=args.sample_size or None,
+                              lazy=args.lazy)
+
+    # plot everything once all chunks are done
+    histograms.render()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,115 @@
 """a module to store the cuts function"""
+import operator
+from typing import Callable, Dict, List, Tuple
 import awkward
+import numpy as np
 
-def make_cuts(data: awkward.Array, particle_id: int):
+# a cut is a name and a function giving a boolean mask for the events
+Cut = Tuple[str, Callable[[awkward.Array], np.ndarray]]
+
+OPERATORS = {
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le,
+    '>': operator.gt, '>=': operator.ge,
+}
+
+
+def leading_two(data: awkward.Array, branch: str, fill_value=0) -> np.ndarray:
+    """
+    The first two entries of a per-lepton branch as an (n_events, 2) array,
+    padded with fill_value for events with fewer leptons.
+    Only this branch is touched.
+    """
+    padded = awkward.pad_none(data[branch], 2, clip=True)
+    return awkward.to_numpy(awkward.fill_none(padded, fill_value))
+
+
+def branch_cut(branch: str, op: str, value, index: int=None) -> Callable:
+    """
+    Declare a cut on one branch, e.g. branch_cut('lep_pt', '>=', 30000, index=0)
+    keeps events whose leading lepton has pT >= 30 GeV. With index=None the
+    comparison is made on the branch itself (one value per event).
+    """
+    compare = OPERATORS[op]
+
+    def cut(data: awkward.Array) -> np.ndarray:
+        if index is None:
+            return awkward.to_numpy(compare(data[branch], value))
+        padded = awkward.pad_none(data[branch], index + 1, clip=True)
+        return awkward.to_numpy(
+            awkward.fill_none(compare(padded[:, index], value), False))
+    return cut
+
+
+def standard_cuts(particle_id: int) -> List[Cut]:
+    """the Z selection: 2 leptons, same type opposite sign, pt>25GeV"""
+    def two_leptons(data):
+        # Ensure we have at least two leptons (exactly 2)
+        return awkward.to_numpy(data['lep_n'] == 2)
+
+    def lepton_type(data):
+        # Ensure the leptons are of the right type
+        return np.all(leading_two(data, 'lep_type') == particle_id, axis=1)
+
+    def opposite_charge(data):
+        # Ensure the leptons have the opposite charge (since they came from a Z)
+        charge = leading_two(data, 'lep_charge')
+        return charge[:, 0] == -charge[:, 1]
+
+    def lepton_pt(data):
+        # Ensure both leptons have pT >= 25GeV
+        return np.all(leading_two(data, 'lep_pt') >= 25000, axis=1)
+
+    return [('two leptons', two_leptons),
+            ('lepton type', lepton_type),
+            ('opposite charge', opposite_charge),
+            ('lepton pT', lepton_pt)]
+
+
+def get_mask(data: awkward.Array,
+             particle_id: int,
+             extra_cuts: List[Cut]=None,
+             cut_flow: Dict[str, int]=None) -> np.ndarray:
+    """
+    Combined boolean mask of all cuts, each evaluated against the unfiltered data.
+
+    extra_cuts: more (name, function) cuts, see branch_cut
+    cut_flow: if given, the number of events passing each successive cut is
+              added to it (so it can accumulate over chunks)
+    """
+    mask = np.ones(len(data), dtype=bool)
+    if cut_flow is not None:
+        cut_flow['all events'] = cut_flow.get('all events', 0) + len(data)
+    for name, cut in standard_cuts(particle_id) + list(extra_cuts or []):
+        mask &= cut(data)
+        if cut_flow is not None:
+            cut_flow[name] = cut_flow.get(name, 0) + int(np.count_nonzero(mask))
+    return mask
+
+
+def make_cuts(data: awkward.Array,
+              particle_id: int,
+              extra_cuts: List[Cut]=None,
+              cut_flow: Dict[str, int]=None):
     """
     A function to make cuts based on what particles we have.
 
     data: unfiltered data from one of the files,
-    particle_id: PDG ID of the lepton used in the file, 11/13 for e/mu"""
-    # Ensure we have at least two leptons (exactly 2)
-    data = data[data['lep_n'] == 2]
-
-    # Ensure the leptons are of the right type
-    data = data[(data['lep_type'][:, 0] == particle_id) *
-                (data['lep_type'][:, 0] == particle_id)]
+    particle_id: PDG ID of the lepton used in the file, 11/13 for e/mu
+    extra_cuts: more (name, function) cuts, see branch_cut
+    cut_flow: dict to accumulate the events passing each cut, see get_mask
 
-    # Ensure the leptons have the opposite charge (since they came from a Z)
-    data = data[data['lep_charge'][:, 0] == -data['lep_charge'][:, 1]]
+    The masks are combined first, so the data is only sliced once."""
+    return data[get_mask(data, particle_id, extra_cuts, cut_flow)]
 
-    # Ensure both leptons have pT >= 25GeV
-    data = data[(data['lep_pt'][:, 0] >= 25000) *
-                (data['lep_pt'][:, 1] >= 25000)]
 
-    # more cuts here if needed ...
-    return data
+def print_cut_flow(cut_flow: Dict[str, int]):
+    """print a cut-flow table: events passing each cut, and the efficiencies"""
+    n_all = next(iter(cut_flow.values()), 0)
+    n_previous = n_all
+    print(f'{"cut":>16} {"events":>10} {"relative":>9} {"cumulative":>11}')
+    for name, n_pass in cut_flow.items():
+        relative = n_pass / n_previous if n_previous else 0.
+        cumulative = n_pass / n_all if n_all else 0.
+        print(f'{name:>16} {n_pass:>10} {relative:>9.3f} {cumulative:>11.3f}')
+        n_previous = n_pass
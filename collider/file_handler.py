@@ -1,27 +1,68 @@
 """file_handler.py handles reading data from root files"""
 
+import hashlib
+import json
 import os
-from typing import List
+import shutil
+import urllib.request
+from typing import Iterator, List
+import awkward as ak
+import numpy as np
 import uproot
 
 OPEN_DATA_URL = 'http://opendata.atlas.cern/release/samples/Data/'  # +filename
 
+# branches read by open_file are cached here as raw, memory-mappable buffers
+CACHE_DIR = os.environ.get(
+    'COLLIDER_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'trisep_collider'))
+CACHE_MAX_BYTES = int(os.environ.get('COLLIDER_CACHE_MAX_BYTES', 4 * 1024**3))
+
+
+def resolve_filename(filename: str) -> str:
+    """Return the local path if the file exists here, otherwise the OpenData link"""
+    if not os.path.exists(filename):
+        filename = OPEN_DATA_URL + filename
+        print(f'Using remote file: {filename}, may be slow!')
+    return filename
+
 
 def open_file(filename: str,
               branches:List[str]=None,
-              sample_size:int=None):
+              sample_size:int=None,
+              entry_start:int=0,
+              use_cache:bool=True,
+              lazy:bool=False):
     """
     Open a root file, for the given particle type, branches, and sample size
 
     filename: something like 'DataMuons.root'
     branches: branches you need: ['lep_pt', 'lep_eta', ...], less = quicker
     sample_size: how many events to return, use smaller samples for testing
+    entry_start: first event to return (e.g. to read one chunk of the file)
+    use_cache: load/store the arrays in the local cache (see CACHE_DIR),
+               later calls with the same request skip reading the root file
+    lazy: return LazyEvents instead, reading each branch only when it is first
+          used and only for the events still selected (the cache is not used)
 
     """
     # get filename, either as the file in this directory or the OpenData link
-    if not os.path.exists(filename):
-        filename = OPEN_DATA_URL + filename
-        print(f'Using remote file: {filename}, may be slow!')
+    filename = resolve_filename(filename)
+    entry_stop = None if sample_size is None else entry_start + sample_size
+
+    if lazy:
+        tree = uproot.open(filename)["mini"]
+        if entry_stop is None:
+            entry_stop = tree.num_entries
+        return LazyEvents(tree, branches, entry_start, min(entry_stop, tree.num_entries))
+
+    key = None
+    if use_cache:
+        key = cache_key(filename, branches, entry_start, entry_stop)
+        if key is not None:
+            arrays = load_cached(key)
+            if arrays is not None:
+                return arrays
 
     # open the file
     root_file = uproot.open(filename)
@@ -31,16 +72,212 @@ def open_file(filename: str,
 
     # get branches we care about, as AwkwardArrays
     # specifying branches makes this faster, not technically needed
-    if branches is None:
-        arrays = tree.arrays()
-    else:
-        arrays = tree.arrays(branches)
+    # entry_start/entry_stop mean only the requested events are read and decompressed
+    # (use a smaller dataset for testing purposes!)
+    arrays = tree.arrays(branches, entry_start=entry_start, entry_stop=entry_stop)
+
+    if key is not None:
+        store_cached(key, arrays)
+    return arrays
+
+
+def read_entries(branch, entries: np.ndarray) -> ak.Array:
+    """
+    Values of one branch for the given (sorted) entry numbers. Baskets with at
+    least one of those entries are read and decompressed in full (neighbouring
+    ones together); only baskets with none of them are skipped. With baskets of
+    thousands of events, a basket is skipped only if the cuts reject every one
+    of its events, so this saves little unless the selection is very tight or
+    clustered in entry number.
+    """
+    offsets = np.asarray(branch.entry_offsets)
+    baskets = np.unique(np.searchsorted(offsets, entries, side='right') - 1)
+    # split the needed baskets into runs of consecutive baskets
+    runs = np.split(baskets, np.flatnonzero(np.diff(baskets) != 1) + 1)
+    pieces = []
+    for run in runs:
+        if len(run) == 0:
+            continue
+        run_start, run_stop = offsets[run[0]], offsets[run[-1] + 1]
+        values = branch.array(entry_start=run_start, entry_stop=run_stop)
+        in_run = entries[(entries >= run_start) & (entries < run_stop)]
+        pieces.append(values[in_run - run_start])
+    if not pieces:
+        return branch.array(entry_start=0, entry_stop=0)
+    return ak.concatenate(pieces)
+
+
+class LazyEvents:
+    """
+    Events from a 'mini' tree whose branches are read on first access, so
+    branches that are never used are never read. Selecting with a boolean mask
+    (data[mask]) only records the surviving entries; branches first used after
+    the cuts are read with read_entries, which still decompresses every basket
+    holding a surviving event, so the saving there is per basket only.
+
+    e.g. data = open_file('DataMuons.root', lazy=True)
+         data = data[data['lep_n'] == 2]
+         data['lep_eta']  # read now, values kept for events with two leptons
+    """
+    def __init__(self, tree, branches: List[str], entry_start: int,
+                 entry_stop: int, entries: np.ndarray=None):
+        self.tree = tree
+        self.branches = list(tree.keys()) if branches is None else list(branches)
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
+        self.entries = entries  # selected entry numbers, None means all
+        self.columns = {}
+
+    def __len__(self) -> int:
+        if self.entries is None:
+            return self.entry_stop - self.entry_start
+        return len(self.entries)
+
+    @property
+    def fields(self) -> List[str]:
+        """names of the branches that can be used"""
+        return self.branches
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.branch(key)
+        # a selection: keep the entries, and the columns already read
+        mask = ak.to_numpy(key) if isinstance(key, ak.Array) else np.asarray(key)
+        if self.entries is None:
+            entries = np.arange(self.entry_start, self.entry_stop)[mask]
+        else:
+            entries = self.entries[mask]
+        selected = LazyEvents(self.tree, self.branches, self.entry_start,
+                              self.entry_stop, entries)
+        selected.columns = {name: column[mask] for name, column in self.columns.items()}
+        return selected
 
-    # Use a smaller dataset for testing purposes!
-    if sample_size is None:
-        return arrays
-    return arrays[:sample_size]
+    def branch(self, name: str) -> ak.Array:
+        """the values of one branch for the selected events, read when first needed"""
+        if name not in self.branches:
+            raise KeyError(name)
+        if name not in self.columns:
+            if self.entries is None:
+                self.columns[name] = self.tree[name].array(
+                    entry_start=self.entry_start, entry_stop=self.entry_stop)
+            else:
+                self.columns[name] = read_entries(self.tree[name], self.entries)
+        return self.columns[name]
 
 
+def source_signature(filename: str) -> str:
+    """
+    Identify the current version of a file: path, modification time and size.
+    For remote files these come from the HTTP headers; None if unavailable.
+    """
+    if os.path.exists(filename):
+        stat = os.stat(filename)
+        return f'{os.path.abspath(filename)}:{stat.st_mtime_ns}:{stat.st_size}'
+    try:
+        request = urllib.request.Request(filename, method='HEAD')
+        with urllib.request.urlopen(request, timeout=10) as response:
+            modified = response.headers.get('Last-Modified')
+            size = response.headers.get('Content-Length')
+    except (OSError, ValueError):
+        return None
+    if modified is None and size is None:
+        return None
+    return f'{filename}:{modified}:{size}'
+
+
+def cache_key(filename: str,
+              branches: List[str],
+              entry_start: int,
+              entry_stop: int) -> str:
+    """key of a cache entry: the file version and exactly what was read from it"""
+    signature = source_signature(filename)
+    if signature is None:
+        return None
+    request = json.dumps([signature, branches, entry_start, entry_stop])
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def load_cached(key: str) -> ak.Array:
+    """arrays of a cache entry, memory-mapped (no copy), or None if not cached"""
+    entry = os.path.join(CACHE_DIR, key)
+    try:
+        with open(os.path.join(entry, 'form.json'), encoding='utf-8') as form_file:
+            header = json.load(form_file)
+        container = {
+            name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+            for name in header['buffers']}
+    except (OSError, ValueError, KeyError):
+        return None
+    os.utime(entry)  # mark as recently used
+    return ak.from_buffers(ak.forms.from_dict(header['form']),
+                           header['length'], container)
+
+
+def store_cached(key: str, arrays: ak.Array):
+    """write arrays to the cache, then evict least recently used entries"""
+    form, length, buffers = ak.to_buffers(arrays)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entry = os.path.join(CACHE_DIR, key)
+    partial = f'{entry}.{os.getpid()}.tmp'
+    os.makedirs(partial, exist_ok=True)
+    for name, buffer in buffers.items():
+        np.save(os.path.join(partial, name + '.npy'), buffer)
+    with open(os.path.join(partial, 'form.json'), 'w', encoding='utf-8') as form_file:
+        json.dump({'form': form.to_dict(), 'length': length,
+                   'buffers': list(buffers)}, form_file)
+    # the entry appears complete or not at all (another process may have won)
+    try:
+        os.rename(partial, entry)
+    except OSError:
+        shutil.rmtree(partial, ignore_errors=True)
+    evict_cache(CACHE_MAX_BYTES)
+
+
+def evict_cache(max_bytes: int):
+    """delete least recently used cache entries until the cache fits in max_bytes"""
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        entry = os.path.join(CACHE_DIR, name)
+        if name.endswith('.tmp') or not os.path.isdir(entry):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def clear_cache():
+    """delete all cached arrays"""
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+
+def get_num_entries(filename: str) -> int:
+    """number of events in the 'mini' tree of a file"""
+    return uproot.open(resolve_filename(filename))["mini"].num_entries
+
+
+def iterate_events(filename: str,
+                   branches: List[str]=None,
+                   step_size: int=100000,
+                   entry_start: int=None,
+                   entry_stop: int=None) -> Iterator[ak.Array]:
+    """
+    Read a root file chunk by chunk, so memory use is bounded by step_size
+
+    filename: something like 'DataMuons.root'
+    branches: branches you need: ['lep_pt', 'lep_eta', ...], less = quicker
+    step_size: number of events per chunk (or a size string like '100 MB')
+    entry_start, entry_stop: range of events to read, None for the whole tree
+
+    e.g. for chunk in iterate_events('DataMuons.root', ['lep_n']): ...
+    """
+    tree = uproot.open(resolve_filename(filename))["mini"]
+    yield from tree.iterate(branches, step_size=step_size,
+                            entry_start=entry_start, entry_stop=entry_stop)
+
 if __name__ == '__main__':
     open_file('DataMuons.root')  # takes like 10 seconds to run
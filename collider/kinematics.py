@@ -0,0 +1,185 @@
+"""
+Fast Z-candidate kinematics from the two leading leptons.
+
+All Z observables are computed in one pass into preallocated arrays, with
+vectorized numpy, or numba for large arrays when it is installed.
+The analysis in collision.py stays on numpy: a chunk keeps only a few
+thousand events after the cuts, too few to pay for loading the kernel.
+Run this file to benchmark it against the vector package.
+"""
+import time
+from typing import Dict
+import awkward as ak
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # numba is optional, the numpy kernel is used without it
+    numba = None
+
+Z_OBSERVABLES = ['mass', 'pt', 'eta', 'phi', 'E']
+# Loading the compiled kernel costs over a second per process, while numpy
+# reconstructs the ~1500 selected events of a chunk (collision.STEP_SIZE) in
+# about a millisecond. Smaller arrays therefore use the numpy kernel, which
+# keeps the worker processes of collision.run_analysis off numba.
+NUMBA_MIN_EVENTS = 100000
+
+
+def leading_pair(variable: ak.Array) -> np.ndarray:
+    """
+    The first two entries of a per-lepton variable as a contiguous
+    (n_events, 2) numpy array, gathered straight from the awkward buffers.
+    Every event must have at least two entries (true after cuts.make_cuts).
+    """
+    layout = ak.to_layout(variable)
+    index = None
+    if isinstance(layout, ak.contents.IndexedArray):  # e.g. after a selection
+        index = np.asarray(layout.index)
+        layout = layout.content
+    if isinstance(layout, ak.contents.ListOffsetArray):
+        offsets = np.asarray(layout.offsets)
+        starts, stops = offsets[:-1], offsets[1:]
+        if (index is None and isinstance(layout.content, ak.contents.NumpyArray)
+                and np.all(stops - starts == 2)):
+            # exactly two leptons everywhere: a view of the buffer, no copy
+            values = np.asarray(layout.content.data)
+            return values[offsets[0]:offsets[-1]].reshape(-1, 2)
+    elif isinstance(layout, ak.contents.ListArray):
+        starts, stops = np.asarray(layout.starts), np.asarray(layout.stops)
+    else:
+        starts = stops = None
+    if starts is None or not isinstance(layout.content, ak.contents.NumpyArray):
+        return ak.to_numpy(variable[:, :2])
+    if index is not None:
+        starts, stops = starts[index], stops[index]
+    if np.any(stops - starts < 2):
+        raise ValueError('every event needs at least two leptons')
+    values = np.asarray(layout.content.data)
+    return values[starts[:, np.newaxis] + np.arange(2)]
+
+
+def z_kernel_numpy(pt, eta, phi, energy, mass, z_pt, z_eta, z_phi, z_energy):
+    """sum the two leptons of each event, writing into the output arrays"""
+    # momentum components, summed over the two leptons (axis 1)
+    np.sum(pt * np.cos(phi), axis=1, out=z_phi)  # px for now
+    np.sum(pt * np.sin(phi), axis=1, out=z_eta)  # py for now
+    p_z = np.sum(pt * np.sinh(eta), axis=1)
+    np.sum(energy, axis=1, out=z_energy)
+
+    np.hypot(z_phi, z_eta, out=z_pt)
+    # mass**2 = E**2 - p**2, keeping the sign for unphysical negative values
+    np.subtract(z_energy**2, z_pt**2 + p_z**2, out=mass)
+    np.copysign(np.sqrt(np.abs(mass)), mass, out=mass)
+    np.arctan2(z_eta, z_phi, out=z_phi)
+    np.arcsinh(p_z / z_pt, out=z_eta)
+
+
+def z_kernel_loop(pt, eta, phi, energy, mass, z_pt, z_eta, z_phi, z_energy):
+    """same as z_kernel_numpy, one event at a time (compiled by numba)"""
+    for i in range(pt.shape[0]):
+        p_x = pt[i, 0] * np.cos(phi[i, 0]) + pt[i, 1] * np.cos(phi[i, 1])
+        p_y = pt[i, 0] * np.sin(phi[i, 0]) + pt[i, 1] * np.sin(phi[i, 1])
+        p_z = pt[i, 0] * np.sinh(eta[i, 0]) + pt[i, 1] * np.sinh(eta[i, 1])
+        e_sum = energy[i, 0] + energy[i, 1]
+        p_t = np.sqrt(p_x * p_x + p_y * p_y)
+        mass_squared = e_sum * e_sum - p_t * p_t - p_z * p_z
+        mass[i] = np.copysign(np.sqrt(np.abs(mass_squared)), mass_squared)
+        z_pt[i] = p_t
+        z_eta[i] = np.arcsinh(p_z / p_t)
+        z_phi[i] = np.arctan2(p_y, p_x)
+        z_energy[i] = e_sum
+
+
+if numba is not None:
+    z_kernel_numba = numba.njit(cache=True, error_model='numpy')(z_kernel_loop)
+else:
+    z_kernel_numba = None
+
+
+def z_kinematics(pt: np.ndarray,
+                 eta: np.ndarray,
+                 phi: np.ndarray,
+                 energy: np.ndarray,
+                 out: Dict[str, np.ndarray]=None,
+                 use_numba: bool=True) -> Dict[str, np.ndarray]:
+    """
+    Kinematics of the sum of the two leading leptons.
+
+    pt, eta, phi, energy: (n_events, 2) arrays, e.g. from leading_pair
+    out: preallocated output arrays (keys Z_OBSERVABLES, length n_events),
+         reused between chunks to avoid allocations
+    use_numba: use the compiled kernel if numba is installed and there are
+               at least NUMBA_MIN_EVENTS events
+
+    returns {'mass': ..., 'pt': ..., 'eta': ..., 'phi': ..., 'E': ...}
+    """
+    pt, eta, phi, energy = (np.ascontiguousarray(x, dtype=np.float64)
+                            for x in (pt, eta, phi, energy))
+    n_events = len(pt)
+    if out is None or len(out['mass']) != n_events:
+        out = {name: np.empty(n_events) for name in Z_OBSERVABLES}
+
+    kernel = z_kernel_numpy
+    if use_numba and z_kernel_numba is not None and n_events >= NUMBA_MIN_EVENTS:
+        kernel = z_kernel_numba
+    with np.errstate(invalid='ignore', divide='ignore'):
+        kernel(pt, eta, phi, energy, out['mass'], out['pt'], out['eta'],
+               out['phi'], out['E'])
+    return out
+
+
+def benchmark(n_events: int=1000000, repeat: int=5):
+    """
+    compare with the vector package (vector.zip, then lead + next), both
+    starting from jagged awkward leptons as they come out of the cuts
+    """
+    import vector
+
+    # events with 1-3 leptons, then keep those with two like cuts.make_cuts
+    rng = np.random.default_rng(0)
+    counts = rng.choice([1, 2, 3], size=n_events, p=[0.1, 0.8, 0.1])
+    n_leptons = np.sum(counts)
+    pt = rng.exponential(30., n_leptons) + 25.
+    eta = rng.normal(0., 1.5, n_leptons)
+    phi = rng.uniform(-np.pi, np.pi, n_leptons)
+    leptons = ak.zip({'pt': pt, 'eta': eta, 'phi': phi, 'E': pt * np.cosh(eta)})
+    leptons = ak.unflatten(leptons, counts)[counts == 2]
+    leptons = {name: leptons[name] for name in ['pt', 'eta', 'phi', 'E']}
+    n_events = len(leptons['pt'])
+
+    def vector_path():
+        lepton_vectors = vector.zip(leptons)
+        z_candidate = lepton_vectors[:, 0] + lepton_vectors[:, 1]
+        return {'mass': z_candidate.mass, 'pt': z_candidate.pt,
+                'eta': z_candidate.eta, 'phi': z_candidate.phi,
+                'E': z_candidate.E}
+
+    out = {name: np.empty(n_events) for name in Z_OBSERVABLES}
+
+    def kernel_path(use_numba):
+        return z_kinematics(*(leading_pair(leptons[name])
+                              for name in ['pt', 'eta', 'phi', 'E']),
+                            out=out, use_numba=use_numba)
+
+    paths = {'vector': vector_path,
+             'numpy': lambda: kernel_path(False)}
+    if z_kernel_numba is not None:
+        z_kernel_numba(*([np.ones((1, 2))] * 4 + [np.empty(1)] * 5))  # compile
+        paths['numba'] = lambda: kernel_path(True)
+
+    reference = {name: ak.to_numpy(values) for name, values in vector_path().items()}
+    for name, path in paths.items():
+        times = []
+        for _ in range(repeat):
+            tick = time.perf_counter()
+            result = path()
+            times.append(time.perf_counter() - tick)
+        difference = max(np.max(np.abs(np.asarray(result[key]) - reference[key])
+                                / np.maximum(np.abs(reference[key]), 1.))
+                         for key in Z_OBSERVABLES)
+        print(f'{name:>7}: {n_events / min(times):12.0f} events/s, '
+              f'max relative difference to vector {difference:.1e}')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,28 +1,183 @@
 """contains plotting functions"""
-from typing import Tuple
+import copy
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Tuple
 import awkward as ak
+import numpy as np
 import matplotlib.pyplot as plt
 
 
-def plot_histogram(variable: ak.Array,
-                   n_bins: int,
-                   range_tuple: Tuple[float],
-                   save_name: str=None,
-                   xlabel: str=None,
-                   ylabel: str=None,
-                   title: str=None):
-    """e.g. plot_histogram(data['lep_pt'], 100, (0, 100))"""
-    all_lep_pt = ak.to_numpy(ak.flatten(variable, axis=None))
-    plt.hist(all_lep_pt, n_bins, range_tuple)
+def finish_plot(save_name: str=None,
+                xlabel: str=None,
+                ylabel: str=None,
+                title: str=None):
+    """add labels to the current plot, then show or save it"""
     if xlabel is not None:
         plt.xlabel(xlabel)
     if ylabel is not None:
         plt.ylabel(ylabel)
     if title is not None:
-        plt.title(title)    
+        plt.title(title)
 
     if save_name is None:
         plt.show()
     else:
         plt.savefig(save_name)
         plt.close()
+
+
+def plot_histogram(variable: ak.Array,
+                   n_bins: int,
+                   range_tuple: Tuple[float],
+                   save_name: str=None,
+                   xlabel: str=None,
+                   ylabel: str=None,
+                   title: str=None):
+    """e.g. plot_histogram(data['lep_pt'], 100, (0, 100))"""
+    all_lep_pt = ak.to_numpy(ak.flatten(variable, axis=None))
+    plt.hist(all_lep_pt, n_bins, range_tuple)
+    finish_plot(save_name, xlabel, ylabel, title)
+
+
+def flat_values(variable) -> np.ndarray:
+    """
+    All values of variable (any nesting) as a flat numpy array.
+    For plain list offsets this is a view of the underlying buffer, no copy.
+    """
+    layout = ak.to_layout(variable)
+    while True:
+        if isinstance(layout, ak.contents.NumpyArray):
+            return np.asarray(layout.data).reshape(-1)
+        if isinstance(layout, ak.contents.ListOffsetArray):
+            offsets = np.asarray(layout.offsets)
+            layout = layout.content[offsets[0]:offsets[-1]]
+        elif isinstance(layout, ak.contents.RegularArray):
+            layout = layout.content[:layout.length * layout.size]
+        else:
+            # indexed/masked layouts (e.g. after a selection) need a real flatten
+            return ak.to_numpy(ak.flatten(ak.Array(layout), axis=None))
+
+
+class Histogram:
+    """
+    A histogram that is filled chunk by chunk and plotted once at the end.
+    Histograms with the same binning can be merged by adding them.
+
+    e.g. hist = Histogram(100, (0, 100), save_name='lep_pt.png')
+         for chunk in chunks: hist.fill(chunk['lep_pt'] / 1000)
+         hist.plot()
+    """
+    def __init__(self,
+                 n_bins: int,
+                 range_tuple: Tuple[float],
+                 save_name: str=None,
+                 xlabel: str=None,
+                 ylabel: str=None,
+                 title: str=None):
+        self.edges = np.linspace(range_tuple[0], range_tuple[1], n_bins + 1)
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.save_name = save_name
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.title = title
+
+    def fill(self, variable: ak.Array):
+        """add the values of variable (any nesting) to the counts, same binning as np.histogram"""
+        values = flat_values(variable)
+        n_bins = len(self.counts)
+        low, high = self.edges[0], self.edges[-1]
+        values = values[(values >= low) & (values <= high)].astype(np.float64, copy=False)
+
+        # uniform bins: compute the index directly, then fix rounding at the edges like np.histogram
+        indices = ((values - low) * (n_bins / (high - low))).astype(np.intp)
+        indices[indices == n_bins] -= 1
+        indices[values < self.edges[indices]] -= 1
+        indices[(values >= self.edges[indices + 1]) & (indices != n_bins - 1)] += 1
+        self.counts += np.bincount(indices, minlength=n_bins)
+
+    def __iadd__(self, other: 'Histogram') -> 'Histogram':
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('cannot merge histograms with different binning')
+        self.counts += other.counts
+        return self
+
+    def __add__(self, other: 'Histogram') -> 'Histogram':
+        merged = Histogram(len(self.counts), (self.edges[0], self.edges[-1]),
+                           self.save_name, self.xlabel, self.ylabel, self.title)
+        merged.counts = self.counts.copy()
+        merged += other
+        return merged
+
+    def plot(self):
+        """draw the accumulated counts, same style as plot_histogram"""
+        plt.hist(self.edges[:-1], self.edges, weights=self.counts)
+        finish_plot(self.save_name, self.xlabel, self.ylabel, self.title)
+
+
+def render_histograms(histograms: List[Histogram], backend: str=None):
+    """plot a list of histograms, e.g. in a background process"""
+    if backend is not None:
+        plt.switch_backend(backend)
+    for hist in histograms:
+        hist.plot()
+
+
+class HistogramBook:
+    """
+    Histograms declared once by name, filled per chunk, merged across
+    chunks/files/workers by adding books, and rendered once at the end.
+
+    e.g. book = HistogramBook()
+         book.book('lep_pt', 25, (0, 100), save_name='lep_pt.png')
+         for chunk in chunks: book.fill('lep_pt', chunk['lep_pt'] / 1000)
+         book.render()
+    """
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+
+    def book(self,
+             name: str,
+             n_bins: int,
+             range_tuple: Tuple[float],
+             save_name: str=None,
+             xlabel: str=None,
+             ylabel: str=None,
+             title: str=None):
+        """declare a histogram"""
+        self.histograms[name] = Histogram(
+            n_bins, range_tuple, save_name, xlabel, ylabel, title)
+
+    def fill(self, name: str, variable: ak.Array):
+        """fill the histogram called name"""
+        self.histograms[name].fill(variable)
+
+    def __getitem__(self, name: str) -> Histogram:
+        return self.histograms[name]
+
+    def __iadd__(self, other: 'HistogramBook') -> 'HistogramBook':
+        for name, hist in other.histograms.items():
+            if name in self.histograms:
+                self.histograms[name] += hist
+            else:
+                self.histograms[name] = copy.deepcopy(hist)
+        return self
+
+    def __add__(self, other: 'HistogramBook') -> 'HistogramBook':
+        merged = HistogramBook()
+        merged += self
+        merged += other
+        return merged
+
+    def render(self, background: bool=False) -> Future:
+        """
+        plot all histograms; with background=True this happens in another
+        process and a Future is returned (call .result() to wait for it)
+        """
+        histograms = list(self.histograms.values())
+        if not background:
+            render_histograms(histograms)
+            return None
+        executor = ProcessPoolExecutor(max_workers=1)
+        future = executor.submit(render_histograms, histograms, 'Agg')
+        executor.shutdown(wait=False)
+        return future
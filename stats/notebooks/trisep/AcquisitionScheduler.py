@@ -0,0 +1,100 @@
+# Non-blocking data taking with asyncio. The lab instruments (RadiationCounter, LifetimeExperiment)
+# have an acquire method that waits for the counting time without blocking the interpreter, and an
+# AcquisitionScheduler runs several of them at the same time against a shared LabClock, so the total
+# wait is the longest counting time instead of the sum.
+#
+# Usage, in a notebook (which already runs an event loop, so await can be used directly):
+# count = await lab_detector.acquire()
+#
+# scheduler = AcquisitionScheduler(progress=print_progress)
+# scheduler.add('calibration', calib_detector)
+# scheduler.add('control', control_detector)
+# scheduler.add('signal', lab_detector)
+# results = await scheduler.run()  # {'calibration': 826, 'control': 5, 'signal': 6}
+#
+# Or get the futures (asyncio Tasks) and carry on while they run:
+# futures = scheduler.start()
+# futures['signal'].add_done_callback(lambda future: print('signal count:', future.result()))
+# scheduler.cancel('control')  # cancelled runs give None in the results
+# results = await scheduler.wait()
+#
+# In a script: results = asyncio.run(scheduler.run())
+import asyncio
+import functools
+import time
+
+
+class LabClock:
+    # Lab time in seconds since the clock was made. speed > 1 runs the lab faster than real time.
+    def __init__(self, speed=1.):
+        self.speed = speed
+        self.start_time = time.monotonic()
+
+    def now(self):
+        return (time.monotonic() - self.start_time) * self.speed
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds / self.speed)
+
+
+async def wait_counting_time(counting_time, progress=None, clock=None, interval=0.5):
+    # wait counting_time seconds of lab time, calling progress(elapsed, counting_time) about every interval
+    if clock is None:
+        clock = LabClock()
+    start = clock.now()
+    while True:
+        elapsed = clock.now() - start
+        if progress is not None:
+            progress(min(elapsed, counting_time), counting_time)
+        if elapsed >= counting_time:
+            return
+        await clock.sleep(min(interval, counting_time - elapsed))
+
+
+def print_progress(name, elapsed, counting_time):
+    print(name, ': {0:5.1f} of {1:5.1f} seconds'.format(elapsed, counting_time))
+
+
+class AcquisitionScheduler:
+    def __init__(self, clock=None, progress=None, interval=0.5):
+        # progress(name, elapsed, counting_time) is called for each run about every interval seconds
+        self.clock = LabClock() if clock is None else clock
+        self.progress = progress
+        self.interval = interval
+        self.instruments = {}
+        self.futures = {}
+
+    def add(self, name, instrument):
+        if name in self.instruments:
+            print('Error: There is already an acquisition called', name)
+        elif any(instrument is other for other in self.instruments.values()):
+            print('Error: This instrument is already used by another acquisition')
+        else:
+            self.instruments[name] = instrument
+
+    def start(self):
+        # start all added runs that are not running yet (needs a running event loop), returns the futures
+        for name, instrument in self.instruments.items():
+            if name not in self.futures:
+                progress = None if self.progress is None else functools.partial(self.progress, name)
+                self.futures[name] = asyncio.ensure_future(
+                    instrument.acquire(progress=progress, clock=self.clock, interval=self.interval))
+        return dict(self.futures)
+
+    def cancel(self, name=None):
+        # cancel one run, or all of them
+        names = list(self.futures) if name is None else [name]
+        for cancel_name in names:
+            self.futures[cancel_name].cancel()
+
+    async def wait(self):
+        # results of all started runs by name, None for cancelled runs
+        await asyncio.gather(*self.futures.values(), return_exceptions=True)
+        results = {}
+        for name, future in self.futures.items():
+            results[name] = None if future.cancelled() else future.result()
+        return results
+
+    async def run(self):
+        self.start()
+        return await self.wait()
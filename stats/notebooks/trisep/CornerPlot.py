@@ -0,0 +1,138 @@
+# A CornerPlot accumulates 1D and pairwise 2D histograms of MCMC samples, chunk by chunk, and draws
+# them once at the end, so the plotting cost does not depend on the length of the chain (unlike
+# pd.plotting.scatter_matrix, which draws every sample). The bins span the min/max of each parameter,
+# or the ranges given, e.g. ranges={'scale_nue': (0.7, 1.3)}. Samples outside a range are left out of
+# the histograms of that parameter only.
+#
+# Usage (parameters as for MarkovChain):
+# corner = CornerPlot(parameters, n_bins=50)
+# corner.fill(chain)  # list of dicts, structured array or DataFrame; can be called for more chunks
+# corner.fill_stream('chain.npy')  # or the new points of a streamed chain, also while it is still running
+# a_low, a_high = corner.get_credible_interval('a', 0.90)  # like np.percentile(a_list, [5., 95.])
+# corner.plot()
+#
+# Weighted samples (e.g. the 'weight' column from MarkovChain.reweight) are filled with weights=.
+import numpy as np
+import pandas as pd
+
+import matplotlib.pyplot as plt
+
+from trisep.MarkovChain import load_chain
+
+
+class CornerPlot:
+    def __init__(self, parameter_list, n_bins=50, ranges=None, chunk_size=1000000):
+        self.names = [par['name'] for par in parameter_list]
+        self.n_bins = n_bins
+        self.chunk_size = chunk_size
+        if ranges is None:
+            ranges = {}
+        limits = [ranges.get(par['name'], (par['min'], par['max'])) for par in parameter_list]
+        self.min_array = np.array([low for low, high in limits], dtype=float)
+        self.max_array = np.array([high for low, high in limits], dtype=float)
+        self.edges = [np.linspace(low, high, n_bins + 1) for low, high in zip(self.min_array, self.max_array)]
+        n_parameters = len(self.names)
+        self.counts_1d = np.zeros((n_parameters, n_bins))
+        # pairs (i, j) with i < j, counts indexed [bin of i, bin of j]
+        self.pairs = [(i, j) for i in range(n_parameters) for j in range(i + 1, n_parameters)]
+        self.counts_2d = np.zeros((len(self.pairs), n_bins, n_bins))
+        self.n_samples = 0
+        self.n_outside = np.zeros(n_parameters, dtype=int)  # samples outside the range of each parameter
+        self.stream_points = {}  # points already filled from each streamed chain
+
+    def get_points(self, chain):
+        # the samples as an array of shape (n, n_parameters)
+        if isinstance(chain, pd.DataFrame):
+            return chain[self.names].to_numpy(dtype=float)
+        if isinstance(chain, np.ndarray) and chain.dtype.names is not None:
+            return np.stack([np.ravel(chain[name]) for name in self.names], axis=-1).astype(float)
+        return np.array([[sample[name] for name in self.names] for sample in chain], dtype=float)
+
+    def fill(self, chain, weights=None):
+        points = self.get_points(chain)
+        if weights is not None:
+            weights = np.ravel(np.asarray(weights, dtype=float))
+        for start in range(0, len(points), self.chunk_size):
+            chunk_weights = None if weights is None else weights[start:start + self.chunk_size]
+            self.fill_points(points[start:start + self.chunk_size], chunk_weights)
+
+    def fill_points(self, points, weights=None):
+        # bin index of every sample and parameter at once (the maximum goes in the last bin),
+        # with n_bins for values outside the range, which then fall outside the bincount
+        n_bins = self.n_bins
+        inside = (points >= self.min_array) & (points <= self.max_array)
+        self.n_outside += len(points) - np.count_nonzero(inside, axis=0)
+        with np.errstate(invalid='ignore'):
+            indices = ((points - self.min_array) * (n_bins / (self.max_array - self.min_array)))
+        indices = np.where(inside, np.minimum(indices, n_bins - 1), n_bins).astype(np.intp)
+
+        for i in range(len(self.names)):
+            self.counts_1d[i] += np.bincount(indices[:, i], weights, minlength=n_bins + 1)[:n_bins]
+        for k, (i, j) in enumerate(self.pairs):
+            flat = indices[:, i] * (n_bins + 1) + indices[:, j]
+            counts = np.bincount(flat, weights, minlength=(n_bins + 1) ** 2).reshape(n_bins + 1, n_bins + 1)
+            self.counts_2d[k] += counts[:n_bins, :n_bins]
+        self.n_samples += len(points)
+
+    def fill_stream(self, path):
+        # fill the points of a streamed chain (MarkovChain.stream_chain) written since the last call
+        chain = load_chain(path)
+        n_done = self.stream_points.get(path, 0)
+        step = max(self.chunk_size // max(chain.shape[1], 1), 1)  # rows of n_walkers points
+        for start in range(n_done, len(chain), step):
+            self.fill_points(self.get_points(np.asarray(chain[start:start + step])))
+        self.stream_points[path] = len(chain)
+        return len(chain) - n_done
+
+    def get_marginal(self, name):
+        # bin edges and (unnormalized) counts of the 1D marginal
+        i = self.names.index(name)
+        return self.edges[i], self.counts_1d[i]
+
+    def get_percentile(self, name, q):
+        # percentile(s) q (0 to 100) of the binned marginal, interpolating linearly within the bins
+        edges, counts = self.get_marginal(name)
+        if np.sum(counts) <= 0.:
+            print('Error: No samples filled for', name)
+            return np.nan
+        if self.n_outside[self.names.index(name)] > 0:
+            print('Warning:', self.n_outside[self.names.index(name)], 'samples of', name,
+                  'are outside its range and not included')
+        cdf = np.concatenate([[0.], np.cumsum(counts)]) / np.sum(counts)
+        # skip empty bins, where the cdf is flat, so that the interpolation is well defined
+        keep = np.concatenate([[True], np.diff(cdf) > 0.])
+        return np.interp(np.asarray(q) / 100., cdf[keep], edges[keep])
+
+    def get_credible_interval(self, name, probability=0.9):
+        # equal-tailed credible interval from the binned marginal (the precision is about a bin width)
+        tail = 50. * (1. - probability)
+        low, high = self.get_percentile(name, [tail, 100. - tail])
+        return low, high
+
+    def plot(self, save_name=None, figsize=(10, 10), cmap='viridis'):
+        n_parameters = len(self.names)
+        if np.any(self.n_outside > 0):
+            print('Warning: samples outside the parameter ranges are not shown:', dict(zip(self.names, self.n_outside)))
+        fig, axes = plt.subplots(n_parameters, n_parameters, figsize=figsize, squeeze=False)
+        for i in range(n_parameters):
+            axes[i, i].stairs(self.counts_1d[i], self.edges[i])
+            axes[i, i].set_xlim(self.edges[i][0], self.edges[i][-1])
+        for k, (i, j) in enumerate(self.pairs):
+            # lower triangle: parameter i on the x axis, j on the y axis
+            axes[j, i].pcolormesh(self.edges[i], self.edges[j], self.counts_2d[k].T, cmap=cmap)
+            axes[i, j].set_visible(False)
+        for i in range(n_parameters):
+            axes[-1, i].set_xlabel(self.names[i])
+            if i > 0:
+                axes[i, 0].set_ylabel(self.names[i])
+            for j in range(n_parameters):
+                if j < n_parameters - 1:
+                    axes[j, i].tick_params(labelbottom=False)
+                if i > 0:
+                    axes[j, i].tick_params(labelleft=False)
+        fig.tight_layout()
+        if save_name is None:
+            plt.show()
+        else:
+            fig.savefig(save_name)
+            plt.close(fig)
@@ -0,0 +1,90 @@
+# Cost functions for iminuit.Minuit with analytic gradients: Minuit uses the grad method instead of
+# estimating the gradient with extra likelihood evaluations. Both have errordef = 0.5 (Minuit.LIKELIHOOD)
+# and declare their parameter names, so no wrapper function is needed.
+#
+# Usage:
+# cost = LifetimeCost(full_model, lab_times, ['isotope_lifetime', 'background_fraction', 'time_offset',
+#                                             'time_resolution'])
+# m = Minuit(cost, isotope_lifetime=0.03, background_fraction=0.1, time_offset=0., time_resolution=0.01)
+#
+# Several counters share parameters by mapping each counter parameter to a global name:
+# cost = CounterCost([(sim_detector, observed, {'activity': 'a', 'efficiency': 'eps', 'background': 'b'}),
+#                     (sim_control_detector, observed_control, {'background': 'b'}),
+#                     (sim_calib_detector, observed_calib, {'efficiency': 'eps', 'background': 'b'})])
+# m = Minuit(cost, a=0.4, b=0.1, eps=0.9)
+import numpy as np
+
+from trisep import LifetimeExperiment, RadiationCounter
+
+
+class LifetimeCost:
+    errordef = 0.5
+
+    def __init__(self, experiment, times, parameters=None):
+        # experiment: a SimulatedLifetimeExperiment (binned or not), the other parameters stay at its settings
+        # parameters: names from LifetimeExperiment.PARAMETER_NAMES to fit, in the order Minuit receives them
+        self.experiment = experiment
+        self.times = np.asarray(times, dtype=float).ravel()
+        if parameters is None:
+            parameters = LifetimeExperiment.PARAMETER_NAMES
+        self.parameters = list(parameters)
+        self.indices = [LifetimeExperiment.PARAMETER_NAMES.index(name) for name in self.parameters]
+        self._parameters = {name: None for name in self.parameters}
+        self.ndata = len(self.times)
+        self.last = None  # (values, -log L, gradient) of the last evaluation
+
+    def evaluate(self, values):
+        # Minuit usually asks for the value and the gradient at the same point: compute them together once
+        values = tuple(float(value) for value in values)
+        if self.last is None or self.last[0] != values:
+            for name, value in zip(self.parameters, values):
+                getattr(self.experiment, 'set_' + name)(value)
+            neg_log_likelihood, gradient = self.experiment.get_neg_log_likelihood_and_gradient(self.times)
+            self.last = (values, neg_log_likelihood, gradient[self.indices])
+        return self.last
+
+    def __call__(self, *values):
+        return self.evaluate(values)[1]
+
+    def grad(self, *values):
+        return self.evaluate(values)[2]
+
+
+class CounterCost:
+    errordef = 0.5
+
+    def __init__(self, terms):
+        # terms: list of (counter, counts, names), where names maps the counter parameters
+        # (RadiationCounter.PARAMETER_NAMES) to the fit parameters. Parameters that are not mapped
+        # are taken from the counter settings. The fit parameters are in order of first appearance.
+        self.terms = terms
+        self.parameters = []
+        for counter, counts, names in terms:
+            for name in names.values():
+                if name not in self.parameters:
+                    self.parameters.append(name)
+        self._parameters = {name: None for name in self.parameters}
+        self.ndata = sum(np.size(counts) for counter, counts, names in terms)
+        self.last = None
+
+    def evaluate(self, values):
+        values = tuple(float(value) for value in values)
+        if self.last is None or self.last[0] != values:
+            fit_values = dict(zip(self.parameters, values))
+            neg_log_likelihood = 0.
+            gradient = np.zeros(len(self.parameters))
+            for counter, counts, names in self.terms:
+                settings = {counter_name: fit_values[name] for counter_name, name in names.items()}
+                term, term_gradient = counter.get_neg_log_likelihood_and_gradient(counts, **settings)
+                neg_log_likelihood += np.sum(term)
+                for counter_name, name in names.items():
+                    i = RadiationCounter.PARAMETER_NAMES.index(counter_name)
+                    gradient[self.parameters.index(name)] += np.sum(term_gradient[i])
+            self.last = (values, neg_log_likelihood, gradient)
+        return self.last
+
+    def __call__(self, *values):
+        return self.evaluate(values)[1]
+
+    def grad(self, *values):
+        return self.evaluate(values)[2]
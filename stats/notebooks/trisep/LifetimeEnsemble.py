@@ -0,0 +1,277 @@
+# A LifetimeEnsemble generates many simulated lifetime experiments (pseudo-experiments) in one call,
+# for studies of estimator bias and interval coverage, and fits each of them by maximum likelihood.
+# Every experiment has counting_time/le_max_time events, so the times come as a regular 2D array
+# with one row per experiment. The experiments are sharded over worker processes, each drawing
+# from an independent SeedSequence stream.
+#
+# Usage:
+# ensemble = LifetimeEnsemble(10000, counting_time=10., seed=1, n_workers=8)
+# times = ensemble.generate({'isotope_lifetime': 0.03, 'background_fraction': 0.1})  # shape (10000, 50)
+# fits = ensemble.fit(times, {'isotope_lifetime': 0.03, 'background_fraction': 0.1}, free=['isotope_lifetime'])
+# coverage = np.mean(np.abs(fits['isotope_lifetime'] - 0.03) < fits['isotope_lifetime_error'])
+#
+# The experiments of a shard are fitted together: damped Newton steps for all of them at once, with -log L
+# and its analytic gradient evaluated for all rows in one vectorized call (see batch_minimize).
+#
+# fit(..., binning=50) uses the binned likelihood (see SimulatedLifetimeExperiment.set_binning), and
+# ensemble.binning_bias(parameters, 50) compares binned with unbinned fits of the same experiments.
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from trisep import LifetimeExperiment
+from trisep.LifetimeExperiment import SimulatedLifetimeExperiment
+
+# parameters of SimulatedLifetimeExperiment (each has a set_<name> method) and their allowed ranges
+PARAMETER_LIMITS = {
+    'isotope_lifetime': (1.e-4, 0.2),
+    'time_resolution': (0., 0.2),
+    'time_offset': (-0.2, 0.2),
+    'background_fraction': (0., 1.),
+}
+
+
+class LifetimeEnsemble:
+    def __init__(self, n_experiments, counting_time=10., seed=None, n_workers=1):
+        self.n_experiments = n_experiments
+        self.counting_time = counting_time
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.n_workers = n_workers
+
+    def split(self, n):
+        # sizes of the shards given to the workers
+        return [len(shard) for shard in np.array_split(np.arange(n), self.n_workers) if len(shard) > 0]
+
+    def map(self, function, *shard_arguments):
+        if self.n_workers == 1:
+            return [function(*arguments) for arguments in zip(*shard_arguments)]
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            return list(executor.map(function, *shard_arguments))
+
+    def generate(self, parameters):
+        # times for n_experiments pseudo-experiments at one parameter point, shape (n_experiments, n_events)
+        sizes = self.split(self.n_experiments)
+        seeds = self.seed_sequence.spawn(len(sizes))
+        shards = self.map(generate_shard, [parameters] * len(sizes), [self.counting_time] * len(sizes),
+                          sizes, seeds)
+        return np.concatenate(shards)
+
+    def generate_grid(self, parameter_points):
+        # times for each of a list of parameter points, shape (n_points, n_experiments, n_events)
+        return np.stack([self.generate(parameters) for parameters in parameter_points])
+
+    def fit(self, times, start, free=None, limits=None, binning=None):
+        # Maximum likelihood fit of each experiment (row of times). Parameters not in free are fixed
+        # to their start values. Returns a structured array with the estimate and approximate error
+        # (from the curvature of the log likelihood) of each free parameter, and the minimum -log L.
+        # binning (bins or bin edges) selects the binned likelihood.
+        if free is None:
+            free = list(start)
+        fit_limits = dict(PARAMETER_LIMITS)
+        if limits is not None:
+            fit_limits.update(limits)
+        sizes = self.split(len(times))
+        shards = np.split(times, np.cumsum(sizes)[:-1])
+        n_shards = len(shards)
+        results = self.map(fit_shard, shards, [start] * n_shards, [free] * n_shards,
+                           [fit_limits] * n_shards, [binning] * n_shards)
+        return np.concatenate(results)
+
+    def binning_bias(self, parameters, binning, free=None, limits=None):
+        # Fit the same pseudo-experiments with the unbinned and the binned likelihood and report, for each
+        # free parameter, the mean shift (binned - unbinned) with its standard error, and relative to the
+        # mean statistical error of the unbinned fits.
+        if free is None:
+            free = list(parameters)
+        times = self.generate(parameters)
+        unbinned = self.fit(times, parameters, free, limits)
+        binned = self.fit(times, parameters, free, limits, binning)
+        good = unbinned['success'] & binned['success']
+        bias = {}
+        for name in free:
+            shift = binned[name][good] - unbinned[name][good]
+            shift_error = np.std(shift) / np.sqrt(max(len(shift), 1))
+            relative = np.mean(shift) / np.nanmean(unbinned[name + '_error'][good])
+            bias[name] = (np.mean(shift), shift_error, relative)
+            print(name, ': binned - unbinned =', np.mean(shift), '+/-', shift_error,
+                  '(', relative, 'of the statistical error )')
+        return bias
+
+
+def make_experiment(parameters, seed=None):
+    experiment = SimulatedLifetimeExperiment(seed=seed)
+    set_parameters(experiment, parameters)
+    return experiment
+
+
+def set_parameters(experiment, parameters):
+    for name, value in parameters.items():
+        getattr(experiment, 'set_' + name)(value)
+
+
+def generate_shard(parameters, counting_time, n_experiments, seed):
+    experiment = make_experiment(parameters, seed)
+    n_events = int(counting_time / experiment.le_max_time)
+    times = experiment.produce_times_vectorized(n_events * n_experiments)
+    return times.reshape(n_experiments, n_events)
+
+
+def fit_shard(times, start, free, limits, binning=None):
+    experiment = make_experiment(start)
+    experiment.set_binning(binning)
+    parameters = np.array([getattr(experiment, 'le_' + name) for name in LifetimeExperiment.PARAMETER_NAMES])
+    indices = [LifetimeExperiment.PARAMETER_NAMES.index(name) for name in free]
+    bounds = np.array([limits[name] for name in free], dtype=float)
+    times = np.asarray(times, dtype=float)
+    edges = experiment.bin_edges
+    if edges is not None:
+        counts, outside = histogram_rows(times, edges)
+
+    def neg_log_likelihood_and_gradient(rows, x):
+        # -log L and its gradient with respect to the free parameters, for the experiments in rows at x
+        values = np.tile(parameters, (len(rows), 1))
+        values[:, indices] = x
+        tau, sigma, mu, bf = values.T
+        if edges is None:
+            value, gradient = LifetimeExperiment.neg_log_likelihood_and_gradient(
+                times[rows], tau, sigma, mu, bf, experiment.le_max_time)
+        else:
+            value, gradient = LifetimeExperiment.binned_neg_log_likelihood_and_gradient(
+                counts[rows], edges, tau, sigma, mu, bf, experiment.le_max_time)
+            value = np.where(outside[rows] > 0, np.inf, value)
+        return value, gradient[indices].T
+
+    x_start = np.tile([start[name] for name in free], (len(times), 1)).astype(float)
+    x, value, hessian, success = batch_minimize(neg_log_likelihood_and_gradient, x_start, bounds)
+    errors = hessian_errors(hessian)
+
+    dtype = [(name, float) for name in free] + [(name + '_error', float) for name in free] + \
+            [('neg_log_likelihood', float), ('success', bool)]
+    results = np.zeros(len(times), dtype=dtype)
+    for j, name in enumerate(free):
+        results[name] = x[:, j]
+        results[name + '_error'] = errors[:, j]
+    results['neg_log_likelihood'] = value
+    results['success'] = success
+    return results
+
+
+def histogram_rows(times, edges):
+    # counts in the bins for each row of times, and the number of times of each row outside the bins
+    n_bins = len(edges) - 1
+    bins = np.searchsorted(edges, times, side='right') - 1
+    bins[times == edges[-1]] = n_bins - 1  # the last bin includes its upper edge, as in np.histogram
+    inside = (bins >= 0) & (bins < n_bins)
+    row_bins = (np.arange(len(times))[:, np.newaxis] * n_bins + bins)[inside]
+    counts = np.bincount(row_bins, minlength=len(times) * n_bins).reshape(len(times), n_bins)
+    return counts, times.shape[1] - np.sum(counts, axis=1)
+
+
+def batch_minimize(function, x, bounds, tolerance=1.e-8, relative_tolerance=2.2e-9, max_iterations=200):
+    # Minimize many independent problems at once. function(rows, x) gives the values (n_rows,) and gradients
+    # (n_rows, n) of the problems in rows at the points x (n_rows, n). Each iteration takes a Newton step,
+    # with the Hessian from differences of the gradient, damped (Levenberg-Marquardt) until it lowers the
+    # value. Parameters at a bound that the gradient pushes against are held fixed. A problem has converged
+    # when the expected decrease of the value (EDM) of a full Newton step is below tolerance, or when a step
+    # lowers the value by less than relative_tolerance (relative, as for L-BFGS-B) or no step lowers it.
+    # Returns the minima, the values there, the Hessians and whether each problem converged.
+    n_rows, n = x.shape
+    x = np.clip(x, bounds[:, 0], bounds[:, 1])
+    value, gradient = function(np.arange(n_rows), x)
+    hessian = np.zeros((n_rows, n, n))
+    stale = np.ones(n_rows, dtype=bool)  # the Hessian is not at x
+    damping = np.full(n_rows, 1.e-3)
+    scale = 1. / (bounds[:, 1] - bounds[:, 0]) ** 2  # smallest diagonal used for the damping
+    success = np.zeros(n_rows, dtype=bool)
+    active = np.isfinite(value) & np.all(np.isfinite(gradient), axis=1)
+
+    for iteration in range(max_iterations):
+        rows = np.flatnonzero(active)
+        if len(rows) == 0:
+            break
+        update = rows[stale[rows]]
+        hessian[update] = get_hessian(function, update, x[update], bounds)
+        stale[update] = False
+
+        row_x, row_gradient = x[rows], gradient[rows]
+        fixed = ((row_x <= bounds[:, 0]) & (row_gradient > 0.)) | ((row_x >= bounds[:, 1]) & (row_gradient < 0.))
+        row_gradient = np.where(fixed, 0., row_gradient)
+        row_hessian = np.where(fixed[:, :, np.newaxis] | fixed[:, np.newaxis, :], 0., hessian[rows])
+        row_hessian[:, np.arange(n), np.arange(n)] += fixed
+
+        newton, positive = solve_symmetric(row_hessian, row_gradient)
+        edm = np.where(positive, 0.5 * np.sum(row_gradient * newton, axis=1), np.inf)
+        converged = edm < tolerance
+        success[rows[converged]] = True
+        active[rows[converged]] = False
+        rows, row_x, row_gradient, row_hessian = (array[~converged] for array in
+                                                  (rows, row_x, row_gradient, row_hessian))
+        if len(rows) == 0:
+            break
+
+        # damp the step until the damped Hessian is positive definite
+        diagonal = np.maximum(np.abs(np.diagonal(row_hessian, axis1=1, axis2=2)), scale)
+        for attempt in range(30):
+            damped = row_hessian + damping[rows, np.newaxis, np.newaxis] * (diagonal[:, :, np.newaxis] * np.eye(n))
+            step, positive = solve_symmetric(damped, row_gradient)
+            if np.all(positive):
+                break
+            damping[rows[~positive]] *= 10.
+
+        trial = np.clip(row_x - step, bounds[:, 0], bounds[:, 1])
+        trial_value, trial_gradient = function(rows, trial)
+        better = (trial_value < value[rows]) & np.all(np.isfinite(trial_gradient), axis=1)
+        accepted = rows[better]
+        small = value[accepted] - trial_value[better] <= \
+            relative_tolerance * np.maximum(np.maximum(np.abs(value[accepted]), np.abs(trial_value[better])), 1.)
+        x[accepted] = trial[better]
+        value[accepted] = trial_value[better]
+        gradient[accepted] = trial_gradient[better]
+        stale[accepted] = True
+        damping[accepted] = np.maximum(damping[accepted] / 10., 1.e-9)
+        damping[rows[~better]] *= 10.
+        success[accepted[small]] = True
+        active[accepted[small]] = False
+        # No damped step lowers the value any more: a minimum within the numerical precision, where the
+        # Hessian is not positive definite (e.g. a kink of -log L at time_resolution = 0)
+        stuck = rows[damping[rows] > 1.e10]
+        success[stuck] = True
+        active[stuck] = False
+
+    update = np.flatnonzero(stale & np.isfinite(value))
+    hessian[update] = get_hessian(function, update, x[update], bounds)
+    return x, value, hessian, success
+
+
+def solve_symmetric(matrices, vectors):
+    # solutions of matrices @ solution = vectors for a stack of symmetric matrices, and whether each is
+    # positive definite
+    eigenvalues, eigenvectors = np.linalg.eigh(matrices)
+    positive = np.all(eigenvalues > 0., axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        projections = np.einsum('rji,rj->ri', eigenvectors, vectors) / eigenvalues
+    return np.einsum('rij,rj->ri', eigenvectors, projections), positive
+
+
+def get_hessian(function, rows, x, bounds):
+    # Hessians of the problems in rows at x, from central differences of the gradients (2n gradient
+    # evaluations of all rows at once). The steps are kept inside the bounds.
+    n = x.shape[1]
+    steps = 1.e-3 * np.maximum(bounds[:, 1] - bounds[:, 0], 1.e-3)
+    x = np.clip(x, bounds[:, 0] + steps, bounds[:, 1] - steps)
+    hessian = np.empty((len(rows), n, n))
+    for i in range(n):
+        x_up = x.copy()
+        x_up[:, i] += steps[i]
+        x_down = x.copy()
+        x_down[:, i] -= steps[i]
+        hessian[:, :, i] = (function(rows, x_up)[1] - function(rows, x_down)[1]) / (2. * steps[i])
+    return 0.5 * (hessian + np.swapaxes(hessian, 1, 2))
+
+
+def hessian_errors(hessian):
+    # square roots of the diagonal of the inverse of each Hessian of -log L, NaN where it is not positive
+    eigenvalues, eigenvectors = np.linalg.eigh(hessian)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variances = np.sum(eigenvectors ** 2 / eigenvalues[:, np.newaxis, :], axis=2)
+        return np.where(np.isfinite(variances) & (variances > 0.), np.sqrt(np.abs(variances)), np.nan)
@@ -4,20 +4,167 @@
 # There is also a background process that produces uniform times (-0.2,0.2)
 # Reported times are between -0.2 and 0.2 seconds (collecting most of the decays). A fixed number of
 # events are returned: counting_time/le_max_time
+#
+# Times are produced by a NumPy-vectorized engine driven by a seedable np.random.Generator.
+# Pass vectorized=False to use the original event-by-event scipy path (for comparisons).
+#
+# For large datasets, SimulatedLifetimeExperiment.set_binning(100) switches get_log_likelihood to a
+# binned likelihood: the times are histogrammed once and each evaluation costs O(bins) instead of O(N).
+# Passing the same times again only costs a checksum of them to notice changes; after
+# experiment.set_data(times), get_log_likelihood() without times skips that as well.
+#
+# get_neg_log_likelihood_and_gradient gives -log L and its analytic gradient with respect to PARAMETER_NAMES,
+# used by trisep.CostFunction.LifetimeCost to give Minuit the gradient. The module functions
+# neg_log_likelihood_and_gradient and binned_neg_log_likelihood_and_gradient do the same for many datasets.
+#
+# times = await experiment.acquire() does the same as start() and get_times() without blocking the
+# interpreter while waiting (see trisep.AcquisitionScheduler to run several instruments at once).
 
-import pickle
 import time
 
 import numpy as np
 from scipy import stats
 
+from trisep.AcquisitionScheduler import wait_counting_time
+from trisep.TrisepConstants import get_constants
+
+# order of the parameters in the gradients of SimulatedLifetimeExperiment (each has a set_<name> method)
+PARAMETER_NAMES = ['isotope_lifetime', 'time_resolution', 'time_offset', 'background_fraction']
+
+
+# The signal model and the likelihoods as functions of the parameters: lifetime tau, resolution sigma,
+# offset mu and background fraction bf. signal_cdf and signal_derivatives broadcast the parameters against
+# the times. The likelihoods sum over the last axis of the times (or counts) and broadcast the parameters
+# against the other axes, so one call evaluates many datasets, e.g. parameters of shape (M,) for M datasets
+# in the rows of times of shape (M, N) (used by trisep.LifetimeEnsemble to fit them all at once).
+
+def signal_cdf(times, tau, sigma, mu):
+    # cdf of the signal before the cutoff at +/- le_max_time
+    exponential = np.asarray(sigma) == 0.
+    if exponential.all():  # pure exponential
+        return stats.expon.cdf(times, mu, tau)
+    if not exponential.any():  # exponential convoluted with normal
+        return stats.exponnorm.cdf(times, tau / sigma, mu, sigma)
+    # datasets of both kinds
+    times, tau, sigma, mu, exponential = np.broadcast_arrays(np.asarray(times, dtype=float), tau, sigma, mu,
+                                                             exponential)
+    cdf = np.empty(times.shape)
+    cdf[exponential] = signal_cdf(times[exponential], tau[exponential], 0., mu[exponential])
+    convolved = ~exponential
+    cdf[convolved] = signal_cdf(times[convolved], tau[convolved], sigma[convolved], mu[convolved])
+    return cdf
+
+
+def signal_derivatives(times, tau, sigma, mu):
+    # Signal pdf g (before the cutoff) and the derivatives of g and of its cdf F with respect to
+    # tau, sigma and mu. Each derivative array has shape (3,) + the shape of g.
+    exponential = np.asarray(sigma) == 0.
+    if exponential.all():  # pure exponential (the derivatives with respect to sigma vanish at sigma = 0)
+        pdf = stats.expon.pdf(times, mu, tau)
+        dt = np.maximum(times - np.asarray(mu), 0.)
+        d_pdf = np.zeros((3,) + pdf.shape)
+        d_cdf = np.zeros((3,) + pdf.shape)
+        d_pdf[0] = pdf * (dt / tau - 1.) / tau
+        d_pdf[2] = pdf / tau
+        d_cdf[0] = -dt * pdf / tau
+        d_cdf[2] = -pdf
+        return pdf, d_pdf, d_cdf
+    if not exponential.any():  # exponential convoluted with normal, with u = (t - mu)/sigma and r = sigma/tau
+        pdf = stats.exponnorm.pdf(times, tau / sigma, mu, sigma)
+        u = (times - np.asarray(mu)) / sigma
+        r = sigma / tau
+        phi = stats.norm.pdf(u)
+        d_pdf = np.array(np.broadcast_arrays(pdf * (-1. - r * r + u * r) / tau + phi * r / tau ** 2,
+                                             pdf * sigma / tau ** 2 - phi * (u / sigma + 1. / tau) / tau,
+                                             (pdf - phi / sigma) / tau))
+        d_cdf = np.array(np.broadcast_arrays(pdf * r * (r - u) - phi * r / tau, (phi - sigma * pdf) / tau, -pdf))
+        return pdf, d_pdf, d_cdf
+    # datasets of both kinds
+    times, tau, sigma, mu, exponential = np.broadcast_arrays(np.asarray(times, dtype=float), tau, sigma, mu,
+                                                             exponential)
+    pdf = np.empty(times.shape)
+    d_pdf = np.empty((3,) + times.shape)
+    d_cdf = np.empty((3,) + times.shape)
+    for subset, subset_sigma in ((exponential, 0.), (~exponential, sigma[~exponential])):
+        pdf[subset], d_pdf[:, subset], d_cdf[:, subset] = signal_derivatives(times[subset], tau[subset],
+                                                                             subset_sigma, mu[subset])
+    return pdf, d_pdf, d_cdf
+
+
+def normalization_derivatives(tau, sigma, mu, max_time):
+    # the integral of the signal pdf over the window and its derivatives with respect to tau, sigma, mu,
+    # with a last axis of length 1 to broadcast against the times
+    window = np.array([-max_time, max_time])
+    tau, sigma, mu = (np.expand_dims(parameter, -1) for parameter in (tau, sigma, mu))
+    cdf = signal_cdf(window, tau, sigma, mu)
+    d_cdf = signal_derivatives(window, tau, sigma, mu)[2]
+    return cdf[..., 1:] - cdf[..., :1], d_cdf[..., 1:] - d_cdf[..., :1]
+
+
+def neg_log_likelihood_and_gradient(times, tau, sigma, mu, bf, max_time):
+    # -log L of the unbinned likelihood (a sum over the last axis of times) and its gradient with
+    # respect to PARAMETER_NAMES (along the first axis), +inf where a time is outside the window
+    # or has zero probability
+    times = np.asarray(times, dtype=float)
+    integral, d_integral = normalization_derivatives(tau, sigma, mu, max_time)
+    tau_, sigma_, mu_ = (np.expand_dims(parameter, -1) for parameter in (tau, sigma, mu))
+    signal_pdf, d_signal_pdf, _ = signal_derivatives(times, tau_, sigma_, mu_)
+    # same cutoff of very small signal pdf values as get_pdf
+    use_special = times - mu_ > -5. * sigma_
+    signal_pdf = np.where(use_special, signal_pdf, 0.)
+    d_signal_pdf = np.where(use_special, d_signal_pdf, 0.)
+
+    bf = np.expand_dims(bf, -1)
+    uniform_pdf = 1. / (2. * max_time)
+    pdf = bf * uniform_pdf + (1. - bf) * signal_pdf / integral
+    valid = np.all((-max_time <= times) & (times < max_time) & (pdf > 0.), axis=-1)
+
+    # d pdf / d theta for tau, sigma, mu, then the background fraction
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        d_pdf = (1. - bf) * (d_signal_pdf / integral - signal_pdf * d_integral / integral ** 2)
+        d_pdf_bf = uniform_pdf - signal_pdf / integral
+        gradient = -np.sum(np.concatenate([d_pdf, d_pdf_bf[np.newaxis]]) / pdf, axis=-1)
+        neg_log_likelihood = -np.sum(np.log(pdf), axis=-1)
+    return np.where(valid, neg_log_likelihood, np.inf), np.where(valid, gradient, 0.)
+
+
+def binned_neg_log_likelihood_and_gradient(counts, edges, tau, sigma, mu, bf, max_time):
+    # The same for the multinomial likelihood of histogram counts (last axis) in the bins with the given
+    # edges, with the probabilities divided by the bin widths (see get_binned_log_likelihood)
+    counts = np.asarray(counts)
+    edges = np.asarray(edges, dtype=float)
+    clipped = np.clip(edges, -max_time, max_time)
+    integral, d_integral = normalization_derivatives(tau, sigma, mu, max_time)
+    tau_, sigma_, mu_ = (np.expand_dims(parameter, -1) for parameter in (tau, sigma, mu))
+    signal_fraction = signal_cdf(clipped, tau_, sigma_, mu_) - signal_cdf(-max_time, tau_, sigma_, mu_)
+    d_signal_fraction = signal_derivatives(clipped, tau_, sigma_, mu_)[2] - \
+        signal_derivatives(-max_time, tau_, sigma_, mu_)[2]
+
+    bf = np.expand_dims(bf, -1)
+    uniform_cdf = (clipped + max_time) / (2. * max_time)
+    probabilities = np.diff(bf * uniform_cdf + (1. - bf) * signal_fraction / integral, axis=-1)
+    filled = counts > 0
+    valid = ~np.any(filled & (probabilities <= 0.), axis=-1)
+
+    # derivatives of the mixture cdf at the bin edges, then of the bin probabilities
+    d_cdf = (1. - bf) * (d_signal_fraction / integral - signal_fraction * d_integral / integral ** 2)
+    d_cdf_bf = uniform_cdf - signal_fraction / integral
+    d_probabilities = np.diff(np.concatenate([d_cdf, d_cdf_bf[np.newaxis]]), axis=-1)
+
+    widths = np.diff(edges)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        neg_log_likelihood = -np.sum(np.where(filled, counts * np.log(probabilities / widths), 0.), axis=-1)
+        gradient = -np.sum(np.where(filled, counts * d_probabilities / probabilities, 0.), axis=-1)
+    return np.where(valid, neg_log_likelihood, np.inf), np.where(valid, gradient, 0.)
+
 
 class LifetimeExperiment:
-    def __init__(self, bypass_wait=False):
+    def __init__(self, bypass_wait=False, seed=None, vectorized=True):
         self.counting_time = 10.
         self.bypass_wait = bypass_wait
-        with open('trisep.p', 'rb') as f:
-            TC = pickle.load(f)
+        self.rng = np.random.default_rng(seed)
+        self.vectorized = vectorized
+        TC = get_constants()
         self.le_max_time = 0.2
         self.le_isotope_lifetime = TC.le_isotope_lifetime  # should be much less than le_max_time
         self.le_time_resolution = TC.le_time_resolution
@@ -47,31 +194,81 @@ class LifetimeExperiment:
             time.sleep(self.counting_time)
         self.produce_times()
 
+    async def acquire(self, progress=None, clock=None, interval=0.5):
+        # start() without blocking: progress(elapsed, counting_time) is called while waiting, and
+        # cancelling the task stops the run without producing times
+        if not self.bypass_wait:
+            await wait_counting_time(self.counting_time, progress, clock, interval)
+        self.produce_times()
+        return self.times
+
     def produce_times(self):
+        if self.vectorized:
+            self.times = self.produce_times_vectorized()
+        else:
+            self.times = self.produce_times_scalar()
+        return
+
+    def produce_times_vectorized(self, n_events=None):
+        if n_events is None:
+            n_events = int(self.counting_time / self.le_max_time)
+        times = np.empty(n_events)
+
+        # split the events into background and signal all at once
+        is_background = self.rng.random(n_events) < self.le_background_fraction
+        n_background = np.count_nonzero(is_background)
+        times[is_background] = self.le_max_time * 2. * (self.rng.random(n_background) - 0.5)
+        times[~is_background] = self.produce_signal_times(n_events - n_background)
+        return times
+
+    def produce_signal_times(self, n_signal):
+        # batched rejection: draw more candidates than needed, keep those in range, repeat for the rest
+        signal_times = np.empty(n_signal)
+        n_filled = 0
+        acceptance = 1.
+        while n_filled < n_signal:
+            n_needed = n_signal - n_filled
+            n_draw = min(int(1.2 * n_needed / acceptance) + 16, 100 * n_needed + 16)
+            decay_times = self.rng.exponential(self.le_isotope_lifetime, n_draw)
+            # add offset and resolution
+            observed_times = decay_times + self.rng.normal(self.le_time_offset, self.le_time_resolution, n_draw)
+            observed_times = observed_times[(-self.le_max_time < observed_times) &
+                                            (observed_times < self.le_max_time)]
+            acceptance = max(len(observed_times) / n_draw, 0.01)
+            n_keep = min(len(observed_times), n_needed)
+            signal_times[n_filled:n_filled + n_keep] = observed_times[:n_keep]
+            n_filled += n_keep
+        return signal_times
+
+    def produce_times_scalar(self):
         n_events = int(self.counting_time / self.le_max_time)
         times = []
         for i in range(n_events):
-            if stats.uniform.rvs() < self.le_background_fraction:
+            if stats.uniform.rvs(random_state=self.rng) < self.le_background_fraction:
                 # a background event
-                uniform_time = self.le_max_time * 2. * (stats.uniform.rvs() - 0.5)
+                uniform_time = self.le_max_time * 2. * (stats.uniform.rvs(random_state=self.rng) - 0.5)
                 times.append(uniform_time)
             else:
                 # produce a real event within the acceptable range
                 in_range = False
                 observed_time = None
                 while not in_range:
-                    decay_time = stats.expon.rvs(scale=self.le_isotope_lifetime)
+                    decay_time = stats.expon.rvs(scale=self.le_isotope_lifetime, random_state=self.rng)
                     # add offset and resolution
-                    observed_time = decay_time + stats.norm.rvs(self.le_time_offset, self.le_time_resolution)
+                    observed_time = decay_time + stats.norm.rvs(self.le_time_offset, self.le_time_resolution,
+                                                                random_state=self.rng)
                     in_range = -self.le_max_time < observed_time < self.le_max_time
                 times.append(observed_time)
-        self.times = times
-        return
+        return np.array(times)
 
 
 class SimulatedLifetimeExperiment(LifetimeExperiment):
-    def __init__(self, isotope_lifetime=0.05, time_resolution=0., time_offset=0., background_fraction=0.):
+    def __init__(self, isotope_lifetime=0.05, time_resolution=0., time_offset=0., background_fraction=0.,
+                 seed=None, vectorized=True):
         self.counting_time = 10.
+        self.bypass_wait = True  # nothing to wait for in a simulation
+        self.rng = np.random.default_rng(seed)
+        self.vectorized = vectorized
         self.le_max_time = 0.2
         self.le_isotope_lifetime = isotope_lifetime
         self.le_time_resolution = time_resolution
@@ -81,6 +278,12 @@ class SimulatedLifetimeExperiment(LifetimeExperiment):
               "Time resolution =", time_resolution, "Time offset=", time_offset,
               "Background fraction =", background_fraction)
         self.times = None
+        self.normalization = None  # cached integral of the signal pdf over the window, reset by the setters
+        self.bin_edges = None  # None for the unbinned likelihood, see set_binning
+        self.data_times = None  # copy of the times from set_data, used when no times are given
+        self.histogram_key = None  # length and checksum of the times histogrammed in histogram_counts
+        self.histogram_counts = None
+        self.histogram_outside = 0  # number of those times outside the bins
 
     def set_counting_time(self, counting_time):
         if counting_time < 0.:
@@ -91,18 +294,21 @@ class SimulatedLifetimeExperiment(LifetimeExperiment):
     def set_isotope_lifetime(self, isotope_lifetime):
         if 0. <= isotope_lifetime <= self.le_max_time:
             self.le_isotope_lifetime = isotope_lifetime
+            self.normalization = None
         else:
             print('Error: Isotope lifetime must be between 0. and', self.le_max_time)
 
     def set_time_resolution(self, time_resolution):
         if 0. <= time_resolution <= self.le_max_time:
             self.le_time_resolution = time_resolution
+            self.normalization = None
         else:
             print('Error: Time resolution must be between 0. and', self.le_max_time)
 
     def set_time_offset(self, time_offset):
         if -self.le_max_time <= time_offset <= self.le_max_time:
             self.le_time_offset = time_offset
+            self.normalization = None
         else:
             print('Error: Time offset must be between', -self.le_max_time, 'and', self.le_max_time)
 
@@ -112,54 +318,154 @@ class SimulatedLifetimeExperiment(LifetimeExperiment):
         else:
             print('Error: Background fraction must be between 0. and 1.')
 
+    def set_binning(self, bins):
+        # Use a binned likelihood: bins is a number of equal bins over (-le_max_time, le_max_time)
+        # or an increasing array of bin edges covering that range. bins=None restores the unbinned likelihood.
+        if bins is None:
+            edges = None
+        elif np.ndim(bins) == 0:
+            if int(bins) < 1:
+                print('Error: Number of bins must be at least 1')
+                return
+            edges = np.linspace(-self.le_max_time, self.le_max_time, int(bins) + 1)
+        else:
+            edges = np.asarray(bins, dtype=float)
+            if len(edges) < 2 or np.any(np.diff(edges) <= 0.) or \
+                    edges[0] > -self.le_max_time or edges[-1] < self.le_max_time:
+                print('Error: Bin edges must be increasing and cover', -self.le_max_time, 'to', self.le_max_time)
+                return
+        self.bin_edges = edges
+        self.histogram_key = None
+
     def start(self):
         self.produce_times()
 
-    def get_pdf(self, observed_time):
-        # Calculate the pdf
+    def get_signal_cdf(self, times):
+        # cdf of the signal before the cutoff at +/- le_max_time
+        return signal_cdf(times, self.le_isotope_lifetime, self.le_time_resolution, self.le_time_offset)
+
+    def get_normalization(self):
+        # integral of the signal pdf over all possible observations: depends only on the parameters,
+        # so it is computed once and cached until a setter changes them
+        if self.normalization is None:
+            cdfs = self.get_signal_cdf([-self.le_max_time, self.le_max_time])
+            self.normalization = cdfs[1] - cdfs[0]
+        return self.normalization
+
+    def get_cdf(self, observed_times):
+        # fraction of the observed times (the mixture, with the cutoff) below each of observed_times
+        times = np.clip(np.asarray(observed_times, dtype=float), -self.le_max_time, self.le_max_time)
+        bf = self.le_background_fraction
+        uniform_cdf = (times + self.le_max_time) / (2. * self.le_max_time)
+        special_cdf = (self.get_signal_cdf(times) - self.get_signal_cdf(-self.le_max_time)) / \
+            self.get_normalization()
+        return bf * uniform_cdf + (1. - bf) * special_cdf
+
+    def get_bin_probabilities(self, edges):
+        # expected fraction of the times in each bin, from the cdf at the edges
+        return np.diff(self.get_cdf(edges))
+
+    def set_data(self, times):
+        # keep a copy of the times for the likelihood methods called without times
+        self.data_times = np.array(times, dtype=float).ravel()
+        self.histogram_key = None
+
+    def get_data(self, times):
+        # the times given as a flat array, or those from set_data
+        if times is None:
+            if self.data_times is None:
+                print('Error: No times given and none set with set_data')
+                return np.full(1, np.nan)
+            return self.data_times
+        return np.ascontiguousarray(times, dtype=float).ravel()
+
+    def get_histogram(self, times=None):
+        # Counts of times in the bins. The histogram is only made again when the contents of times change, so
+        # the likelihood of the same dataset can be evaluated many times without histogramming it each time.
+        # The contents are checked by the length and the sum of the bit patterns of the values, which catches
+        # changes in place and is much cheaper than the histogram (reordering is not seen, but does not matter).
+        # The copy from set_data cannot change in between, so it is not checked.
+        values = self.get_data(times)
+        if times is None and self.data_times is not None:
+            key = 'data'
+        else:
+            key = (len(values), int(values.view(np.int64).sum()))
+        if self.histogram_key != key:
+            self.histogram_counts = np.histogram(values, self.bin_edges)[0]
+            self.histogram_outside = len(values) - np.sum(self.histogram_counts)
+            self.histogram_key = key
+        return self.histogram_counts
+
+    def get_pdf(self, observed_times):
+        # Calculate the pdf for a single time or an array of times
+        times = np.asarray(observed_times, dtype=float)
         bf = self.le_background_fraction
-        uniform_pdf = 0.
-        special_pdf = 0.
-        if -self.le_max_time <= observed_time < self.le_max_time:
-            # Uniform
-            uniform_pdf = 1. / (2. * self.le_max_time)
-
-            # Convolution of exponential and normal (CUTOFF AT +/- le_max_time, so MUST renormalize)
-            # catch issues where pdf might be very small
-            if observed_time - self.le_time_offset > -5. * self.le_time_resolution:
-                if self.le_time_resolution == 0.:  # pure exponential
-                    # integral over all possible observations:
-                    cdfs = stats.expon.cdf([-self.le_max_time, self.le_max_time], self.le_time_offset,
-                                           self.le_isotope_lifetime)
-                    integral = cdfs[1] - cdfs[0]
-
-                    special_pdf = stats.expon.pdf(observed_time, self.le_time_offset,
-                                                  self.le_isotope_lifetime) / integral
-                else:  # exponential convoluted with normal
-                    # integral over possible range
-                    cdfs = stats.exponnorm.cdf([-self.le_max_time, self.le_max_time],
-                                               self.le_isotope_lifetime / self.le_time_resolution,
-                                               self.le_time_offset, self.le_time_resolution)
-                    integral = cdfs[1] - cdfs[0]
-
-                    special_pdf = stats.exponnorm.pdf(observed_time, self.le_isotope_lifetime / self.le_time_resolution,
-                                                      self.le_time_offset, self.le_time_resolution) / integral
-
-        return bf * uniform_pdf + (1. - bf) * special_pdf
-
-    def get_log_likelihood(self, times):
-        log_lik = -np.Inf
-        zero_pdf = False
-
-        sum_log_pdf = 0.
-        for observed_time in times:
-            pdf = self.get_pdf(observed_time)
-            if pdf <= 0.:
-                zero_pdf = True
-                break
-            sum_log_pdf += np.log(pdf)
-
-        if not zero_pdf:
-            log_lik = sum_log_pdf
-
-        return log_lik
+        uniform_pdf = np.zeros(times.shape)
+        special_pdf = np.zeros(times.shape)
+
+        in_range = (-self.le_max_time <= times) & (times < self.le_max_time)
+        # Uniform
+        uniform_pdf[in_range] = 1. / (2. * self.le_max_time)
+
+        # Convolution of exponential and normal (CUTOFF AT +/- le_max_time, so MUST renormalize)
+        # catch issues where pdf might be very small
+        use_special = in_range & (times - self.le_time_offset > -5. * self.le_time_resolution)
+        if np.any(use_special):
+            integral = self.get_normalization()
+            if self.le_time_resolution == 0.:  # pure exponential
+                special_pdf[use_special] = stats.expon.pdf(times[use_special], self.le_time_offset,
+                                                           self.le_isotope_lifetime) / integral
+            else:  # exponential convoluted with normal
+                special_pdf[use_special] = stats.exponnorm.pdf(times[use_special],
+                                                               self.le_isotope_lifetime / self.le_time_resolution,
+                                                               self.le_time_offset,
+                                                               self.le_time_resolution) / integral
+
+        pdf = bf * uniform_pdf + (1. - bf) * special_pdf
+        if pdf.ndim == 0:
+            return float(pdf)
+        return pdf
+
+    def get_log_likelihood(self, times=None):
+        if self.bin_edges is not None:
+            return self.get_binned_log_likelihood(times)
+        pdf = self.get_pdf(self.get_data(times))
+        if np.any(pdf <= 0.):
+            return -np.inf
+        return np.sum(np.log(pdf))
+
+    def get_binned_log_likelihood(self, times=None):
+        # Multinomial log likelihood of the histogrammed times (the number of events is fixed).
+        # The bin probabilities are divided by the bin widths, so that for narrow bins this approaches
+        # the unbinned log likelihood and the two can be compared directly.
+        counts = self.get_histogram(times)
+        if self.histogram_outside > 0:
+            return -np.inf
+        probabilities = self.get_bin_probabilities(self.bin_edges)
+        filled = counts > 0
+        if np.any(probabilities[filled] <= 0.):
+            return -np.inf
+        widths = np.diff(self.bin_edges)
+        return np.sum(counts[filled] * np.log(probabilities[filled] / widths[filled]))
+
+    def get_signal_derivatives(self, times):
+        # signal pdf and the derivatives of the pdf and cdf with respect to lifetime, resolution and offset
+        return signal_derivatives(times, self.le_isotope_lifetime, self.le_time_resolution, self.le_time_offset)
+
+    def get_neg_log_likelihood_and_gradient(self, times=None):
+        # -log L (binned or unbinned, as get_log_likelihood) and its gradient with respect to PARAMETER_NAMES
+        if self.bin_edges is not None:
+            return self.get_binned_neg_log_likelihood_and_gradient(times)
+        neg_log_likelihood, gradient = neg_log_likelihood_and_gradient(
+            self.get_data(times), self.le_isotope_lifetime, self.le_time_resolution,
+            self.le_time_offset, self.le_background_fraction, self.le_max_time)
+        return float(neg_log_likelihood), gradient
+
+    def get_binned_neg_log_likelihood_and_gradient(self, times=None):
+        counts = self.get_histogram(times)
+        if self.histogram_outside > 0:
+            return np.inf, np.zeros(len(PARAMETER_NAMES))
+        neg_log_likelihood, gradient = binned_neg_log_likelihood_and_gradient(
+            counts, self.bin_edges, self.le_isotope_lifetime, self.le_time_resolution, self.le_time_offset,
+            self.le_background_fraction, self.le_max_time)
+        return float(neg_log_likelihood), gradient
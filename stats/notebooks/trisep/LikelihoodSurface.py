@@ -0,0 +1,407 @@
+# A LikelihoodSurface tabulates a log likelihood once over the min/max bounds of the parameters and
+# then answers queries by interpolation of the table, for repeated profile plots, contours,
+# MCMC and Minuit scans over the same ranges.
+#
+# The table is hierarchical: the bounds are split into n_start cells per parameter, and each cell holds log L at
+# order + 1 equally spaced nodes per parameter, interpolated by a polynomial in each parameter. Each cell is
+# checked half way between its nodes along each parameter, and split in two along the parameters where the
+# interpolation misses by more than tolerance (in units of log L). Only cells that reach within cutoff of the
+# maximum are refined, so the logL calls go to the region around the peak, and cells share the nodes on their
+# boundaries with their neighbours and children, so no point is evaluated twice. The result is checked at
+# n_validate random points within cutoff of the maximum (the error is kept in surface.error) and refined with a
+# smaller tolerance until it passes.
+#
+# The build makes at most max_calls (default 5000) logL calls, the random checks included, and warns if the
+# tolerance is not reached by then. A cell has (order + 1)^d nodes for d parameters, so this suits a few
+# parameters (the radioactivity and lifetime fits, not the 5 of nueT2K). The default cutoff of 12.5 leaves out
+# the region where the posterior is below e^-12.5 = 4e-6 of its peak, which MCMC and profile scans do not
+# reach. For the radioactivity_G posterior the build takes 4389 calls for an error of 0.005, against about 9400
+# calls for the migrad, minos and get_chain(10000) of that notebook.
+#
+# Where log L is -inf (or NaN) the table holds the lowest finite value minus floor. The table is saved in
+# cache_dir (default ~/.cache/trisep, or TRISEP_CACHE_DIR), keyed by a hash of the data, the model name and the
+# settings, so it is only computed once. The cache is only used when both data and model are given: the name of
+# logL does not identify what it computes (closures and lambdas share names), so without them every build
+# tabulates anew.
+#
+# Usage (parameters as for MarkovChain, logL takes a dict like logP):
+# surface = LikelihoodSurface(parameters, get_log_likelihood, data=[observed, observed_control, observed_calib],
+#                             model='radioactivity_G joint', tolerance=0.01)
+# surface.build()
+# mcmc = MarkovChain(parameters, surface.logP_batch, batch_logP=True)
+# m = Minuit(surface.get_cost(), a=0.4, b=0.1, eps=0.9)
+# a_values, profile = surface.profile('a')
+import hashlib
+import os
+
+import numpy as np
+
+default_cache_dir = os.environ.get('TRISEP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'trisep'))
+
+
+def update_hash(digest, data):
+    # add data (numbers, arrays, and lists/tuples/dicts of them) to a hashlib digest
+    if isinstance(data, dict):
+        for key in sorted(data):
+            digest.update(str(key).encode())
+            update_hash(digest, data[key])
+    elif isinstance(data, (list, tuple)):
+        digest.update(b'list%d' % len(data))
+        for item in data:
+            update_hash(digest, item)
+    else:
+        array = np.ascontiguousarray(data)
+        if array.dtype == object:
+            print('Warning: data of type', type(data), 'is hashed by its repr')
+            digest.update(repr(data).encode())
+        else:
+            digest.update(str(array.dtype).encode() + str(array.shape).encode())
+            digest.update(array.tobytes())
+
+
+def lagrange_weights(u, order):
+    # weights of the nodes 0, 1, ..., order for polynomial interpolation at u (in units of the node spacing),
+    # shape u.shape + (order + 1,): the products over j != k of (u - j) / (k - j)
+    nodes = np.arange(order + 1)
+    factors = (np.asarray(u)[..., np.newaxis, np.newaxis] - nodes) / (nodes[:, np.newaxis] - nodes + np.eye(order + 1))
+    factors[..., nodes, nodes] = 1.
+    return np.prod(factors, axis=-1)
+
+
+class LikelihoodSurface:
+    def __init__(self, parameter_list, logL, data=None, model=None, tolerance=0.01, batch_logL=False,
+                 n_start=2, order=4, max_calls=5000, max_level=12, cutoff=12.5, floor=100., n_validate=500,
+                 cache_dir=None):
+        self.names = [par['name'] for par in parameter_list]
+        self.min_array = np.array([par['min'] for par in parameter_list], dtype=float)
+        self.max_array = np.array([par['max'] for par in parameter_list], dtype=float)
+        self.logL = logL
+        self.batch_logL = batch_logL
+        self.data = data
+        self.model = model  # name of what logL computes, identifies the table in the cache together with data
+        self.tolerance = tolerance
+        self.n_start = max(n_start, 1)
+        self.order = max(order, 2)
+        self.max_calls = max_calls
+        self.max_level = max_level
+        self.cutoff = cutoff
+        self.floor = floor
+        self.n_validate = n_validate
+        self.cache_dir = default_cache_dir if cache_dir is None else cache_dir
+
+        # The nodes and check points of all cells are on an integer lattice, so that shared points are found
+        # exactly: a cell of level L along a parameter spans order * 2^(max_level + 1 - L) lattice units
+        n_dim = len(self.names)
+        self.unit = (self.max_array - self.min_array) / (self.n_start * self.order * 2 ** (self.max_level + 1))
+        self.node_offsets = np.indices((self.order + 1,) * n_dim).reshape(n_dim, -1).T  # in node spacings
+        # check points for each parameter, in node spacings: half way between the nodes along that parameter,
+        # at the nodes next to the edges along the others. They are the nodes of the children if the cell is
+        # split along that parameter.
+        checks = []
+        for k in range(n_dim):
+            axes = [np.unique([1, self.order - 1])] * n_dim
+            axes[k] = np.arange(self.order) + 0.5
+            checks.append(np.stack([axis.ravel() for axis in np.meshgrid(*axes, indexing='ij')], axis=-1))
+        self.check_axis = np.repeat(np.arange(n_dim), [len(points) for points in checks])
+        self.check_offsets = np.concatenate(checks)
+
+        self.cell_level = None  # level of each cell along each parameter, 0 for the n_start^d starting cells
+        self.cell_corner = None  # lattice coordinates of the lower corner of each cell
+        self.cell_children = None  # index of the first child of each cell, -1 for leaves
+        self.cell_child_weights = None  # child index = first child + weights . (upper half along each parameter)
+        self.cell_values = None  # log L at the nodes of each cell, shape (n_cells, (order + 1)^d)
+        self.cell_error = None  # largest interpolation error at the check points of each cell, for each parameter
+        self.cell_top = None  # largest log L seen in each cell (at the nodes, or interpolated at the check points)
+        self.cell_centre = None  # lattice coordinates of the centre of each cell, see make_index
+        self.values = {}  # log L at the lattice points evaluated while building
+        self.maximum = None  # largest log L evaluated
+        self.fill_value = None  # replaces non-finite log L values in the table
+        self.error = None  # largest interpolation error found at random points, see validate
+        self.validation = None  # (points, log L) used by validate
+        self.n_logL_calls = 0
+
+    def get_key(self):
+        digest = hashlib.sha256()
+        update_hash(digest, self.data)
+        update_hash(digest, [self.model, self.names, self.min_array, self.max_array, self.tolerance,
+                             self.n_start, self.order, self.max_calls, self.max_level, self.cutoff, self.floor,
+                             self.n_validate])
+        return digest.hexdigest()
+
+    def get_path(self):
+        return os.path.join(self.cache_dir, 'surface_' + self.get_key()[:32] + '.npz')
+
+    def build(self, use_cache=True):
+        # load the table from the cache, or tabulate it and save it
+        if use_cache and (self.data is None or self.model is None):
+            print('Warning: the cache is not used without data and model to identify the likelihood')
+            use_cache = False
+        path = self.get_path() if use_cache else None
+        if use_cache and os.path.exists(path):
+            with np.load(path) as saved:
+                self.cell_level = saved['level']
+                self.cell_corner = saved['corner']
+                self.cell_children = saved['children']
+                self.cell_child_weights = saved['child_weights']
+                self.cell_values = saved['values']
+                self.fill_value = float(saved['fill_value'])
+                self.error = float(saved['error'])
+            self.make_index()
+            return self
+        self.tabulate()
+        if use_cache:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = path + '.tmp.npz'
+            np.savez(tmp_path, level=self.cell_level, corner=self.cell_corner, children=self.cell_children,
+                     child_weights=self.cell_child_weights, values=self.cell_values, fill_value=self.fill_value,
+                     error=self.error)
+            os.replace(tmp_path, path)
+        return self
+
+    def evaluate_logL(self, points):
+        # evaluate logL for an array of parameter vectors, shape (n, n_parameters)
+        self.n_logL_calls += len(points)
+        if self.batch_logL:
+            return np.asarray(self.logL(points), dtype=float)
+        return np.array([self.logL(dict(zip(self.names, point))) for point in points], dtype=float)
+
+    def evaluate_lattice(self, lattice_points):
+        # log L at integer lattice points, shape (n, n_parameters), evaluating only the new ones
+        keys = [tuple(point) for point in lattice_points.tolist()]
+        new_keys = list(dict.fromkeys(key for key in keys if key not in self.values))
+        if len(new_keys) > 0:
+            points = np.minimum(self.min_array + np.array(new_keys) * self.unit, self.max_array)
+            self.values.update(zip(new_keys, self.evaluate_logL(points)))
+        return np.array([self.values[key] for key in keys])
+
+    def get_cell_width(self, level):
+        # width of cells with the given level(s) along each parameter, in lattice units
+        return self.order * 2 ** (self.max_level + 1 - np.asarray(level))
+
+    def get_points(self, corner, level, offsets):
+        # lattice points of a cell at offsets given in its node spacings
+        spacing = self.get_cell_width(level) // self.order
+        return corner + np.rint(offsets * spacing).astype(np.int64)
+
+    def fill(self, values):
+        return np.where(np.isfinite(values), values, self.fill_value)
+
+    def interpolate_cells(self, cells, points):
+        # the polynomial of each cell at a point in it, for arrays of cells and points
+        width = self.get_cell_width(self.cell_level[cells]) * self.unit
+        u = (points - self.min_array - self.cell_corner[cells] * self.unit) / width * self.order
+        weights = lagrange_weights(u, self.order)
+        values = self.fill(self.cell_values[cells]).reshape((len(cells),) + (self.order + 1,) * len(self.names))
+        for k in reversed(range(len(self.names))):
+            values = np.einsum('n...i,ni->n...', values, weights[:, k])
+        return values
+
+    def get_children(self, cell, axes):
+        # corners, levels and child weights of the children of a cell split in two along the parameters axes
+        bits = np.indices((2,) * len(axes)).reshape(len(axes), -1).T
+        level = self.cell_level[cell] + np.isin(np.arange(len(self.names)), axes)
+        corners = np.repeat(self.cell_corner[cell][np.newaxis], len(bits), axis=0)
+        corners[:, axes] += bits * (self.get_cell_width(level)[axes])
+        weights = np.zeros(len(self.names), dtype=int)
+        weights[axes] = 2 ** np.arange(len(axes))[::-1]
+        return corners, level, weights
+
+    def get_children_points(self, cell, axes):
+        # lattice points needed by the children of a cell (their nodes and check points)
+        corners, level, weights = self.get_children(cell, axes)
+        offsets = np.concatenate([self.node_offsets, self.check_offsets])
+        return (corners[:, np.newaxis, :] + self.get_points(0, level, offsets)).reshape(-1, len(self.names))
+
+    def split(self, cell, axes):
+        # split a cell in two along the parameters axes, returns the indices of the children
+        corners, level, weights = self.get_children(cell, axes)
+        first = len(self.cell_level)
+        n_new = len(corners)
+        self.cell_level = np.concatenate([self.cell_level, np.repeat(level[np.newaxis], n_new, axis=0)])
+        self.cell_corner = np.concatenate([self.cell_corner, corners])
+        self.cell_children = np.concatenate([self.cell_children, np.full(n_new, -1)])
+        self.cell_child_weights = np.concatenate([self.cell_child_weights, np.zeros((n_new, len(self.names)), int)])
+        self.cell_values = np.concatenate([self.cell_values, np.zeros((n_new, len(self.node_offsets)))])
+        self.cell_error = np.concatenate([self.cell_error, np.zeros((n_new, len(self.names)))])
+        self.cell_top = np.concatenate([self.cell_top, np.zeros(n_new)])
+        self.cell_children[cell] = first
+        self.cell_child_weights[cell] = weights
+        return np.arange(first, first + n_new)
+
+    def check_cells(self, cells):
+        # evaluate the nodes and check points of new cells and estimate their interpolation errors
+        nodes = np.stack([self.get_points(self.cell_corner[cell], self.cell_level[cell], self.node_offsets)
+                          for cell in cells])
+        checks = np.stack([self.get_points(self.cell_corner[cell], self.cell_level[cell], self.check_offsets)
+                           for cell in cells])
+        node_values = self.evaluate_lattice(nodes.reshape(-1, len(self.names))).reshape(nodes.shape[:2])
+        exact = self.evaluate_lattice(checks.reshape(-1, len(self.names))).reshape(checks.shape[:2])
+        self.cell_values[cells] = node_values
+
+        finite = np.array([value for value in self.values.values() if np.isfinite(value)])
+        if len(finite) == 0:
+            print('Error: logL is not finite anywhere on the grid')
+            self.maximum = self.fill_value = np.nan
+            return
+        self.maximum = np.max(finite)
+        self.fill_value = np.min(finite) - self.floor
+        points = self.min_array + checks.reshape(-1, len(self.names)) * self.unit
+        approximate = self.interpolate_cells(np.repeat(cells, checks.shape[1]), points).reshape(exact.shape)
+        exact = self.fill(exact)
+        error = np.abs(exact - approximate)
+        for k in range(len(self.names)):
+            self.cell_error[cells, k] = np.max(error[:, self.check_axis == k], axis=1)
+        self.cell_top[cells] = np.maximum(np.max(self.fill(node_values), axis=1),
+                                          np.max(np.maximum(exact, approximate), axis=1))
+
+    def tabulate(self):
+        n_dim = len(self.names)
+        self.values = {}
+        self.validation = None
+        self.n_logL_calls = 0
+        # the n_start^d starting cells, in C order of their position
+        starts = np.indices((self.n_start,) * n_dim).reshape(n_dim, -1).T * self.get_cell_width(0)
+        n_cells = len(starts)
+        self.cell_level = np.zeros((n_cells, n_dim), dtype=int)
+        self.cell_corner = starts.astype(np.int64)
+        self.cell_children = np.full(n_cells, -1)
+        self.cell_child_weights = np.zeros((n_cells, n_dim), dtype=int)
+        self.cell_values = np.zeros((n_cells, len(self.node_offsets)))
+        self.cell_error = np.zeros((n_cells, n_dim))
+        self.cell_top = np.zeros(n_cells)
+        new_cells = np.arange(n_cells)
+        n_start_points = (self.n_start * self.order + 1) ** n_dim
+        if n_start_points + self.n_validate > self.max_calls:
+            print('Error: the', n_cells, 'starting cells need', n_start_points, 'logL calls, more than max_calls =',
+                  self.max_calls, '(use fewer parameters, a smaller n_start or order, or a larger max_calls)')
+            self.cell_values = None
+            return
+
+        # The check points of a cell underestimate its error elsewhere, so the result is checked at random
+        # points and refined with a smaller tolerance until it passes. The validation calls are reserved.
+        refine_calls = self.max_calls - self.n_validate
+        tolerance = self.tolerance
+        limited = False
+        while True:
+            if len(new_cells) > 0:
+                self.check_cells(new_cells)
+            # cells to split: leaves reaching within cutoff of the maximum, along the parameters that miss
+            split_axes = (self.cell_error > tolerance) & (self.cell_level < self.max_level)
+            failing = np.flatnonzero((self.cell_children < 0) & (self.cell_top > self.maximum - self.cutoff) &
+                                     np.any(split_axes, axis=1))
+            new_cells = []
+            if not limited:
+                # the cells with the largest errors first, as far as the logL calls allow
+                pending = set()
+                for cell in failing[np.argsort(-np.max(self.cell_error[failing], axis=1))]:
+                    axes = np.flatnonzero(split_axes[cell])
+                    pending.update(key for key in map(tuple, self.get_children_points(cell, axes).tolist())
+                                   if key not in self.values)
+                    if self.n_logL_calls + len(pending) > refine_calls:
+                        limited = True
+                        break
+                    new_cells.extend(self.split(cell, axes))
+            new_cells = np.array(new_cells, dtype=int)
+            if len(new_cells) > 0:
+                continue
+            self.make_index()
+            self.error = self.validate()
+            if self.error <= self.tolerance or limited or tolerance < 1.e-3 * self.tolerance:
+                break
+            tolerance /= 2.
+
+        if self.error > self.tolerance:
+            print('Warning: interpolation error', self.error, 'is above the tolerance', self.tolerance,
+                  '(limited by max_calls =', self.max_calls, ')')
+        print('Likelihood surface:', np.sum(self.cell_children < 0), 'cells,', self.n_logL_calls,
+              'logL calls, largest interpolation error', self.error)
+        self.values = {}
+
+    def make_index(self):
+        # the cell centres used by find_cells to go down the tree
+        self.cell_centre = self.cell_corner + self.get_cell_width(self.cell_level) // 2
+
+    def find_cells(self, points):
+        # index of the leaf cell holding each point (inside the bounds)
+        lattice = (points - self.min_array) / self.unit
+        start = np.clip((lattice // self.get_cell_width(0)).astype(int), 0, self.n_start - 1)
+        cells = np.ravel_multi_index(tuple(start.T), (self.n_start,) * len(self.names))
+        inner = np.flatnonzero(self.cell_children[cells] >= 0)
+        while len(inner) > 0:
+            parent = cells[inner]
+            upper = lattice[inner] >= self.cell_centre[parent]
+            cells[inner] = self.cell_children[parent] + np.sum(upper * self.cell_child_weights[parent], axis=1)
+            inner = inner[self.cell_children[cells[inner]] >= 0]
+        return cells
+
+    def validate(self):
+        # largest interpolation error at random points where log L is within cutoff of the maximum
+        # (the same points each time, so that they are only evaluated once)
+        if self.validation is None:
+            rng = np.random.default_rng(0)
+            threshold = self.maximum - self.cutoff
+            points = []
+            n_found = 0
+            for _ in range(100):
+                trial = rng.uniform(self.min_array, self.max_array, size=(10 * self.n_validate, len(self.names)))
+                trial = trial[self.interpolate_cells(self.find_cells(trial), trial) > threshold]
+                points.append(trial)
+                n_found += len(trial)
+                if n_found >= self.n_validate:
+                    break
+            points = np.concatenate(points)[:self.n_validate]
+            self.validation = (points, self.fill(self.evaluate_logL(points)))
+        points, exact = self.validation
+        approximate = self.interpolate_cells(self.find_cells(points), points)
+        return np.max(np.abs(exact - approximate), initial=0.)
+
+    def interpolate(self, points):
+        # log L at an array of parameter vectors, shape (n, n_parameters), -inf outside the bounds
+        if self.cell_values is None:
+            self.build()
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if self.cell_values is None:
+            return np.full(len(points), np.nan)
+        inside = np.all((points >= self.min_array) & (points <= self.max_array), axis=1)
+        values = np.full(len(points), -np.inf)
+        if np.any(inside):
+            values[inside] = self.interpolate_cells(self.find_cells(points[inside]), points[inside])
+        return values
+
+    def logP(self, params):
+        # for MarkovChain with a dict of parameters
+        return float(self.interpolate([[params[name] for name in self.names]])[0])
+
+    def logP_batch(self, points):
+        # for MarkovChain with batch_logP=True
+        return self.interpolate(points)
+
+    def profile(self, name, n_points=101, n_other=41):
+        # profile log L along one parameter: n_points values and the maximum over a grid of n_other values
+        # of each of the other parameters (from the interpolation, without logL calls)
+        k = self.names.index(name)
+        values = np.linspace(self.min_array[k], self.max_array[k], n_points)
+        others = [np.linspace(low, high, n_other) for i, (low, high) in
+                  enumerate(zip(self.min_array, self.max_array)) if i != k]
+        other_points = np.stack([axis.ravel() for axis in np.meshgrid(*others, indexing='ij')], axis=-1)
+        profile = np.empty(n_points)
+        for i, value in enumerate(values):
+            points = np.insert(other_points, k, value, axis=1)
+            profile[i] = np.max(self.interpolate(points))
+        return values, profile
+
+    def get_cost(self):
+        # -log L for iminuit.Minuit (migrad, scans, contours), with the bounds as limits
+        return SurfaceCost(self)
+
+
+class SurfaceCost:
+    errordef = 0.5
+
+    def __init__(self, surface):
+        self.surface = surface
+        self._parameters = {name: (low, high) for name, low, high in
+                            zip(surface.names, surface.min_array, surface.max_array)}
+
+    def __call__(self, *values):
+        return -self.surface.interpolate([values])[0]
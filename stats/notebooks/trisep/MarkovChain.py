@@ -8,8 +8,63 @@
 # ]
 # mcmc = MarkovChain(parameters, logP)
 # chain = mcmc.get_chain(1000)
+#
+# All random numbers come from self.rng, so MarkovChain(parameters, logP, seed=1) gives a reproducible
+# chain. mcmc.show_progress = False turns off the progress bars.
+#
+# Array mode: K independent walkers are run in lockstep with proposals drawn as arrays from a
+# seeded np.random.Generator. The chain is a structured ndarray (one field per parameter) of
+# shape (n_points, n_walkers). If batch_logP=True, logP is given an array of parameter vectors
+# of shape (n, n_parameters), ordered as in parameter_list, and must return an array of n values.
+# Otherwise logP is called with a dict for each walker, as in get_chain.
+# mcmc = MarkovChain(parameters, logP, seed=1)
+# chain = mcmc.get_array_chain(100000, n_walkers=10)
+# df = mcmc.get_dataframe(chain)
+#
+# Parallel chains: independent, differently seeded chains run across a ProcessPoolExecutor
+# (logP must be picklable, e.g. a module-level function). Every check_interval points the
+# rank-normalized split R-hat and the bulk effective sample size of each parameter (Vehtari et al. 2021)
+# are computed from the second half of the chains. The run stops early once all R-hat values are below
+# r_hat_target and all ESS values are at least min_ess, on n_checks consecutive checks. Each chain
+# starts at a random point within dispersion step widths of start (dispersion=None: anywhere within
+# min/max), as R-hat needs starting points spread wider than the posterior to detect non-convergence.
+# chain = mcmc.run_chains(n_chains=32, n_points=100000, n_workers=32)
+#
+# Adaptive Metropolis (Haario et al.): during n_burn burn-in steps the proposal becomes a
+# multivariate normal with covariance learned from the burn-in samples, scaled by 2.38^2/d and
+# tuned towards target_acceptance. It is then frozen for the n_points returned samples and kept in
+# adapted_cholesky. Samples/s and ESS per logP call are reported. The other array-mode chains use the
+# hypercube step unless they are asked to reuse the learned proposal with use_adapted_proposal=True.
+# chain = mcmc.get_adaptive_chain(100000, n_burn=10000)
+# chain = mcmc.run_chains(n_chains=32, n_points=100000, use_adapted_proposal=True)
+#
+# Streaming: the chain is written in chunks to a memory-mapped .npy file, and after each chunk the
+# RNG state and current position are checkpointed to <path>.checkpoint. A killed run continues
+# from the last checkpoint with resume=True. load_chain memory-maps the samples written so far.
+# chain = mcmc.stream_chain(10000000, 'chain.npy', chunk_size=100000)
+# chain = load_chain('chain.npy')
+#
+# Parallel tempering, for multimodal posteriors: replicas at a ladder of temperatures (geometric from 1 to
+# max_temperature) sample logP/T with steps scaled by sqrt(T), and every swap_interval steps neighbouring
+# replicas try to swap positions. All replicas are evaluated together as a batch of walkers, or one rung
+# per worker process with n_workers. The swap acceptance per rung is reported and the T=1 chain returned.
+# chain = mcmc.get_tempered_chain(100000, n_temperatures=8, max_temperature=100.)
+#
+# Reweighting: a chain sampled with one prior can be reused for another. log_weight gives the log of the
+# new/old posterior ratio for a dict of parameters (or an array of them with batch=True), and reweight
+# returns the samples as a DataFrame with normalized importance weights, or resampled to equal weights.
+# The effective sample size of the weights is reported, with a warning if it is too small to be useful.
+# e.g. nueT2K, uniform in delta instead of uniform in sin(delta):
+# df = mcmc.reweight(chain, lambda pars: -0.5 * np.log(1. - pars['sdcp'] ** 2))
+# normal_ordering = np.sum(df['weight'][df['mo'] > 0])
+import copy
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-from scipy import stats, special
+from scipy import special, stats
 import pandas as pd
 
 import matplotlib.pyplot as plt
@@ -17,7 +72,7 @@ from tqdm import tqdm
 
 
 class MarkovChain:
-    def __init__(self, parameter_list, logP):
+    def __init__(self, parameter_list, logP, seed=None, batch_logP=False):
         self.names = [par['name'] for par in parameter_list]
         self.start = {}
         self.hypercube = {}
@@ -29,6 +84,24 @@ class MarkovChain:
             self.min[par['name']] = par['min']
             self.max[par['name']] = par['max']
         self.logP = logP
+        self.batch_logP = batch_logP
+        self.rng = np.random.default_rng(seed)
+        self.n_logP_calls = 0
+        self.show_progress = True
+        self.proposal_cholesky = None  # proposal of the running chain, None for the hypercube step
+        self.adapted_cholesky = None  # learned by get_adaptive_chain
+        self.r_hat = None
+        self.ess = None
+        self.temperatures = None  # set by get_tempered_chain
+        self.swap_acceptance = None
+        self.reweight_ess = None  # set by reweight
+
+        # the same information as arrays, in the order of parameter_list, for the array mode
+        self.start_array = np.array([self.start[name] for name in self.names], dtype=float)
+        self.step_array = np.array([self.hypercube[name] for name in self.names], dtype=float)
+        self.min_array = np.array([self.min[name] for name in self.names], dtype=float)
+        self.max_array = np.array([self.max[name] for name in self.names], dtype=float)
+        self.dtype = np.dtype([(name, float) for name in self.names])
 
     def get_chain(self, n_points):
 
@@ -37,18 +110,18 @@ class MarkovChain:
 
         n_accept = 0
         lp_curr = self.logP(params)
-        for i in tqdm(range(n_points)):
+        for i in tqdm(range(n_points), disable=not self.show_progress):
             new_params = params.copy()
             valid = True
             for par_name in self.names:
-                new_params[par_name] += self.hypercube[par_name] * (1. - 2. * stats.uniform.rvs())
+                new_params[par_name] += self.hypercube[par_name] * (1. - 2. * self.rng.random())
                 valid = valid and (self.min[par_name] <= new_params[par_name] <= self.max[par_name])
             if valid:
                 lp_new = self.logP(new_params)
                 if lp_new != -np.inf:
                     del_lp = lp_new - lp_curr
                     if del_lp > -30:
-                        if del_lp > 0 or (stats.uniform.rvs() < np.exp(del_lp)):
+                        if del_lp > 0 or (self.rng.random() < np.exp(del_lp)):
                             params = new_params
                             lp_curr = lp_new
                             n_accept += 1
@@ -56,3 +129,441 @@ class MarkovChain:
 
         print('Acceptance fraction:', n_accept / n_points)
         return chain
+
+    def evaluate_logP(self, points):
+        # evaluate logP for an array of parameter vectors, shape (n, n_parameters)
+        self.n_logP_calls += len(points)
+        if self.batch_logP:
+            return np.asarray(self.logP(points), dtype=float)
+        return np.array([self.logP(dict(zip(self.names, point))) for point in points], dtype=float)
+
+    def new_chain_array(self, n_points, n_walkers):
+        # preallocated structured chain, and a plain float view of it with shape (n_points, n_walkers, n_parameters)
+        chain = np.empty((n_points, n_walkers), dtype=self.dtype)
+        return chain, chain.view(float).reshape(n_points, n_walkers, len(self.names))
+
+    def set_proposal(self, use_adapted_proposal=False):
+        # the hypercube step, or the proposal learned by get_adaptive_chain
+        self.proposal_cholesky = None
+        if use_adapted_proposal:
+            if self.adapted_cholesky is None:
+                print('Warning: No adapted proposal, run get_adaptive_chain first. Using the hypercube step')
+            self.proposal_cholesky = self.adapted_cholesky
+
+    def propose(self, position, scale=1.):
+        if self.proposal_cholesky is not None:
+            return position + scale * (self.rng.standard_normal(position.shape) @ self.proposal_cholesky.T)
+        return position + scale * self.step_array * (1. - 2. * self.rng.random(position.shape))
+
+    def advance(self, position, lp, values, beta=1.):
+        # Metropolis steps for all walkers in lockstep, writing each step into values[i]. With beta < 1
+        # (one value, or one per walker) the walkers sample logP*beta, with steps scaled by 1/sqrt(beta).
+        n_walkers = len(position)
+        scale = 1. / np.sqrt(np.reshape(beta, (-1, 1)))
+        n_accept = np.zeros(n_walkers, dtype=int)
+        for i in tqdm(range(len(values)), disable=not self.show_progress):
+            proposal = self.propose(position, scale)
+            valid = np.all((self.min_array <= proposal) & (proposal <= self.max_array), axis=1)
+            lp_new = np.full(n_walkers, -np.inf)
+            if np.any(valid):
+                lp_new[valid] = self.evaluate_logP(proposal[valid])
+            with np.errstate(invalid='ignore', over='ignore'):
+                del_lp = beta * (lp_new - lp)
+                accept = ((lp_new != -np.inf) & (del_lp > -30) &
+                          ((del_lp > 0) | (self.rng.random(n_walkers) < np.exp(np.minimum(del_lp, 0.)))))
+            position[accept] = proposal[accept]
+            lp[accept] = lp_new[accept]
+            n_accept += accept
+            values[i] = position
+        return position, lp, n_accept
+
+    def get_array_chain(self, n_points, n_walkers=1, use_adapted_proposal=False):
+        self.set_proposal(use_adapted_proposal)
+        position = np.tile(self.start_array, (n_walkers, 1))
+        lp = self.evaluate_logP(position)
+        chain, values = self.new_chain_array(n_points, n_walkers)
+        position, lp, n_accept = self.advance(position, lp, values)
+
+        print('Acceptance fraction:', np.sum(n_accept) / (n_points * n_walkers))
+        return chain
+
+    def get_dataframe(self, chain):
+        # a structured chain converts directly, walkers are interleaved point by point
+        return pd.DataFrame(chain.reshape(-1))
+
+    def get_adaptive_chain(self, n_points, n_burn, n_walkers=1, target_acceptance=0.234, adapt_interval=100):
+        n_parameters = len(self.names)
+        position = np.tile(self.start_array, (n_walkers, 1))
+        lp = self.evaluate_logP(position)
+
+        # burn-in: learn the proposal covariance from all burn-in samples so far
+        burn_chain, burn_values = self.new_chain_array(n_burn, n_walkers)
+        self.proposal_cholesky = None
+        log_scale = 0.
+        regularization = 1.e-6 * np.diag(self.step_array ** 2)
+        for i_block, block_start in enumerate(range(0, n_burn, adapt_interval)):
+            block = burn_values[block_start:block_start + adapt_interval]
+            position, lp, n_accept = self.advance(position, lp, block)
+            if self.proposal_cholesky is not None:
+                # Robbins-Monro tuning of the overall scale towards the target acceptance
+                acceptance = np.sum(n_accept) / (len(block) * n_walkers)
+                log_scale += (acceptance - target_acceptance) / np.sqrt(i_block + 1.)
+            history = burn_values[:block_start + len(block)].reshape(-1, n_parameters)
+            if len(history) > n_parameters + 1:
+                covariance = np.atleast_2d(np.cov(history, rowvar=False)) + regularization
+                covariance *= np.exp(2. * log_scale) * 2.38 ** 2 / n_parameters
+                try:
+                    self.proposal_cholesky = np.linalg.cholesky(covariance)
+                except np.linalg.LinAlgError:
+                    pass
+        self.adapted_cholesky = self.proposal_cholesky
+
+        # sampling with the proposal frozen
+        n_calls_start = self.n_logP_calls
+        time_start = time.perf_counter()
+        chain, values = self.new_chain_array(n_points, n_walkers)
+        position, lp, n_accept = self.advance(position, lp, values)
+        elapsed = time.perf_counter() - time_start
+        n_calls = self.n_logP_calls - n_calls_start
+
+        self.ess = {name: float(effective_sample_size(chain[name])) for name in self.names}
+        print('Acceptance fraction:', np.sum(n_accept) / (n_points * n_walkers))
+        print('Samples per second:', n_points * n_walkers / elapsed)
+        print('Effective sample size:', self.ess)
+        print('ESS per logP call:', {name: ess / max(n_calls, 1) for name, ess in self.ess.items()})
+        return chain
+
+    def stream_chain(self, n_points, path, n_walkers=1, chunk_size=10000, resume=False,
+                     use_adapted_proposal=False):
+        # a resumed run continues with the proposal saved in its checkpoint
+        self.set_proposal(use_adapted_proposal)
+        checkpoint_path = path + '.checkpoint'
+        if resume and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'rb') as f:
+                checkpoint = pickle.load(f)
+            chain = np.load(path, mmap_mode='r+')
+            if chain.shape != (n_points, n_walkers) or chain.dtype != self.dtype:
+                print('Error: The chain in', path, 'does not match the requested shape and parameters')
+                return None
+            n_done = checkpoint['n_done']
+            position = checkpoint['position']
+            lp = checkpoint['lp']
+            n_accept = checkpoint['n_accept']
+            self.rng = checkpoint['rng']
+            self.proposal_cholesky = checkpoint['proposal_cholesky']
+            print('Resuming from checkpoint at', n_done, 'points')
+        else:
+            chain = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(n_points, n_walkers))
+            n_done = 0
+            position = np.tile(self.start_array, (n_walkers, 1))
+            lp = self.evaluate_logP(position)
+            n_accept = np.zeros(n_walkers, dtype=int)
+
+        while n_done < n_points:
+            n_step = min(chunk_size, n_points - n_done)
+            values = chain[n_done:n_done + n_step].view(float).reshape(n_step, n_walkers, len(self.names))
+            position, lp, accepted = self.advance(position, lp, values)
+            n_accept += accepted
+            n_done += n_step
+            chain.flush()
+
+            # write the checkpoint atomically, so a kill during the write leaves the previous one intact
+            checkpoint = {'n_done': n_done, 'position': position, 'lp': lp, 'n_accept': n_accept,
+                          'rng': self.rng, 'proposal_cholesky': self.proposal_cholesky}
+            with open(checkpoint_path + '.tmp', 'wb') as f:
+                pickle.dump(checkpoint, f)
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+        print('Acceptance fraction:', np.sum(n_accept) / (n_points * n_walkers))
+        del chain
+        return load_chain(path)
+
+    def get_dispersed_start(self, rng, dispersion=10., max_tries=100):
+        # A random starting point where logP is finite: uniform within dispersion step widths of start
+        # (clipped to min/max), or anywhere within min/max if dispersion is None. Returns (position, lp).
+        if dispersion is None:
+            low, high = self.min_array, self.max_array
+        else:
+            low = np.maximum(self.start_array - dispersion * self.step_array, self.min_array)
+            high = np.minimum(self.start_array + dispersion * self.step_array, self.max_array)
+        for i in range(max_tries):
+            position = rng.uniform(low, high).reshape(1, -1)
+            lp = self.evaluate_logP(position)
+            if np.isfinite(lp[0]):
+                return position, lp
+        print('Warning: No starting point with finite logP found in', max_tries, 'tries, using start')
+        position = self.start_array.reshape(1, -1).copy()
+        return position, self.evaluate_logP(position)
+
+    def run_chains(self, n_chains, n_points, n_workers=None, check_interval=None, r_hat_target=1.01,
+                   min_ess=400., n_checks=2, dispersion=10., use_adapted_proposal=False):
+        self.set_proposal(use_adapted_proposal)
+        if check_interval is None:
+            check_interval = max(n_points // 10, 1)
+
+        # independent generators for each chain, derived from this chain's generator
+        seed_sequence = np.random.SeedSequence(self.rng.integers(2 ** 63))
+        chains = []
+        for child in seed_sequence.spawn(n_chains):
+            chain_mcmc = copy.copy(self)
+            chain_mcmc.rng = np.random.default_rng(child)
+            chain_mcmc.show_progress = False
+            chain_mcmc.n_logP_calls = 0
+            chains.append(chain_mcmc)
+
+        # R-hat assumes overdispersed starting points: each chain starts at its own random point
+        positions = []
+        lps = []
+        for chain_mcmc in chains:
+            position, lp = self.get_dispersed_start(chain_mcmc.rng, dispersion)
+            positions.append(position)
+            lps.append(lp)
+
+        chain, values = self.new_chain_array(n_points, n_chains)
+        n_accept = np.zeros(n_chains, dtype=int)
+        n_done = 0
+        n_passed = 0  # consecutive checks that met the convergence targets
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            while n_done < n_points:
+                n_step = min(check_interval, n_points - n_done)
+                futures = [executor.submit(advance_chain, chains[j], positions[j], lps[j], n_step)
+                           for j in range(n_chains)]
+                for j, future in enumerate(futures):
+                    chain_values, positions[j], lps[j], accepted, chains[j] = future.result()
+                    values[n_done:n_done + n_step, j] = chain_values[:, 0]
+                    n_accept[j] += accepted[0]
+                n_done += n_step
+
+                self.r_hat, self.ess = self.get_diagnostics(chain[:n_done])
+                print('Points per chain:', n_done, ' R-hat:', self.r_hat, ' ESS:', self.ess)
+                # a single check can pass by chance (R-hat fluctuates), so the targets must hold n_checks times in a row
+                if all(r < r_hat_target for r in self.r_hat.values()) and \
+                        all(ess >= min_ess for ess in self.ess.values()):
+                    n_passed += 1
+                else:
+                    n_passed = 0
+                if n_done < n_points and n_passed >= n_checks:
+                    print('Convergence target reached: R-hat <', r_hat_target, 'and ESS >=', min_ess,
+                          'on', n_checks, 'consecutive checks')
+                    break
+
+        self.n_logP_calls += sum(chain_mcmc.n_logP_calls for chain_mcmc in chains)
+        print('Acceptance fraction:', np.sum(n_accept) / (n_done * n_chains))
+        print('Effective sample size:', self.ess)
+        return chain[:n_done]
+
+    def get_tempered_chain(self, n_points, n_temperatures=8, max_temperature=100., temperatures=None,
+                           swap_interval=10, n_walkers=1, n_workers=None, use_adapted_proposal=False):
+        self.set_proposal(use_adapted_proposal)
+        if temperatures is None:
+            temperatures = np.geomspace(1., max_temperature, n_temperatures)
+        self.temperatures = np.asarray(temperatures, dtype=float)
+        betas = 1. / self.temperatures
+        n_rungs = len(betas)
+        if betas[0] != 1.:
+            print('Warning: The lowest temperature is not 1, so the returned chain does not sample logP')
+
+        # walker j of rung k is row k*n_walkers + j, rung 0 is the cold chain
+        walker_betas = np.repeat(betas, n_walkers)
+        position = np.tile(self.start_array, (n_rungs * n_walkers, 1))
+        lp = self.evaluate_logP(position)
+
+        rungs = None
+        executor = None
+        if n_workers is not None:
+            # a copy of this chain for each rung with its own generator, advanced in worker processes
+            seed_sequence = np.random.SeedSequence(self.rng.integers(2 ** 63))
+            rungs = []
+            for child in seed_sequence.spawn(n_rungs):
+                rung_mcmc = copy.copy(self)
+                rung_mcmc.rng = np.random.default_rng(child)
+                rung_mcmc.show_progress = False
+                rung_mcmc.n_logP_calls = 0
+                rungs.append(rung_mcmc)
+            executor = ProcessPoolExecutor(max_workers=n_workers)
+
+        chain, values = self.new_chain_array(n_points, n_walkers)
+        n_accept = np.zeros(n_walkers, dtype=int)
+        n_swap_tries = np.zeros(n_rungs - 1, dtype=int)
+        n_swaps = np.zeros(n_rungs - 1, dtype=int)
+        show_progress = self.show_progress
+        self.show_progress = False
+        try:
+            n_rounds = -(-n_points // swap_interval)
+            for i_round in tqdm(range(n_rounds), disable=not show_progress):
+                n_done = i_round * swap_interval
+                n_step = min(swap_interval, n_points - n_done)
+                if rungs is None:
+                    step_values = np.empty((n_step,) + position.shape)
+                    position, lp, accepted = self.advance(position, lp, step_values, walker_betas)
+                    values[n_done:n_done + n_step] = step_values[:, :n_walkers]
+                    n_accept += accepted[:n_walkers]
+                else:
+                    futures = [executor.submit(advance_chain, rungs[k], position[k * n_walkers:(k + 1) * n_walkers],
+                                               lp[k * n_walkers:(k + 1) * n_walkers], n_step, betas[k])
+                               for k in range(n_rungs)]
+                    for k, future in enumerate(futures):
+                        rows = slice(k * n_walkers, (k + 1) * n_walkers)
+                        rung_values, position[rows], lp[rows], accepted, rungs[k] = future.result()
+                        if k == 0:
+                            values[n_done:n_done + n_step] = rung_values
+                            n_accept += accepted
+
+                # swaps between neighbouring rungs, alternating even and odd pairs
+                for k in range(i_round % 2, n_rungs - 1, 2):
+                    cold = k * n_walkers + np.arange(n_walkers)
+                    hot = cold + n_walkers
+                    with np.errstate(invalid='ignore'):
+                        log_ratio = (betas[k] - betas[k + 1]) * (lp[hot] - lp[cold])
+                    swap = np.log(self.rng.random(n_walkers)) < log_ratio
+                    n_swap_tries[k] += n_walkers
+                    n_swaps[k] += np.sum(swap)
+                    rows = np.concatenate([cold[swap], hot[swap]])
+                    swapped = np.concatenate([hot[swap], cold[swap]])
+                    position[rows] = position[swapped]
+                    lp[rows] = lp[swapped]
+        finally:
+            self.show_progress = show_progress
+            if executor is not None:
+                executor.shutdown()
+        if rungs is not None:
+            self.n_logP_calls += sum(rung_mcmc.n_logP_calls for rung_mcmc in rungs)
+
+        self.swap_acceptance = n_swaps / np.maximum(n_swap_tries, 1)
+        print('Acceptance fraction (T=1):', np.sum(n_accept) / (n_points * n_walkers))
+        print('Temperatures:', np.round(self.temperatures, 3))
+        print('Swap acceptance per rung:', np.round(self.swap_acceptance, 3))
+        return chain
+
+    def reweight(self, chain, log_weight, batch=False, resample=False, n_samples=None, min_ess_fraction=0.1):
+        # chain: from any of the methods above (list of dicts, structured array or DataFrame)
+        if isinstance(chain, pd.DataFrame):
+            df = chain.copy()
+        elif isinstance(chain, np.ndarray):
+            df = self.get_dataframe(chain)
+        else:
+            df = pd.DataFrame(chain)
+        points = df[self.names].to_numpy(dtype=float)
+        if batch:
+            log_weights = np.asarray(log_weight(points), dtype=float)
+        else:
+            log_weights = np.array([log_weight(dict(zip(self.names, point))) for point in points], dtype=float)
+        if np.any(np.isnan(log_weights) | (log_weights == np.inf)) or np.all(log_weights == -np.inf):
+            print('Error: The log weights must be finite or -inf, and not all -inf')
+            return None
+
+        weights = np.exp(log_weights - np.max(log_weights))
+        weights /= np.sum(weights)
+        self.reweight_ess = 1. / np.sum(weights ** 2)
+        print('Reweighting effective sample size:', self.reweight_ess, 'of', len(weights), 'samples')
+        if self.reweight_ess < min_ess_fraction * len(weights):
+            print('Warning: The weights are dominated by a few samples (effective fraction',
+                  self.reweight_ess / len(weights), '). Run a new chain with the new posterior instead.')
+        df['weight'] = weights
+        if not resample:
+            return df
+
+        # systematic resampling: one uniform offset, n_samples evenly spaced points through the weights
+        if n_samples is None:
+            n_samples = len(df)
+        positions = (self.rng.random() + np.arange(n_samples)) / n_samples
+        indices = np.minimum(np.searchsorted(np.cumsum(weights), positions), len(weights) - 1)
+        return df[self.names].iloc[indices].reset_index(drop=True)
+
+    def get_diagnostics(self, chain):
+        # Rank-normalized split R-hat and bulk effective sample size for each parameter, using the second
+        # half of each chain (the first half is treated as burn-in)
+        kept = chain[len(chain) // 2:]
+        r_hat = {}
+        ess = {}
+        for name in self.names:
+            r_hat[name] = float(gelman_rubin(kept[name]))
+            ess[name] = float(effective_sample_size(rank_normalize(split_chains(kept[name]))))
+        return r_hat, ess
+
+
+def load_chain(path):
+    # memory-map a streamed chain (read only), keeping only the points completed at the last checkpoint
+    chain = np.load(path, mmap_mode='r')
+    checkpoint_path = path + '.checkpoint'
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        chain = chain[:checkpoint['n_done']]
+    return chain
+
+
+def advance_chain(mcmc, position, lp, n_points, beta=1.):
+    # run one chain for n_points in a worker process. Returns the chain mcmc object to carry its RNG state.
+    if lp is None:
+        lp = mcmc.evaluate_logP(position)
+    chain, values = mcmc.new_chain_array(n_points, len(position))
+    position, lp, n_accept = mcmc.advance(position, lp, values, beta)
+    return values, position, lp, n_accept, mcmc
+
+
+def split_chains(samples):
+    # each chain of samples of shape (n_points, n_chains) cut into halves, shape (n_points // 2, 2 * n_chains),
+    # so that a trend within a chain shows up as a difference between chains
+    samples = np.asarray(samples, dtype=float)
+    half = samples.shape[0] // 2
+    return np.concatenate([samples[:half], samples[samples.shape[0] - half:]], axis=1)
+
+
+def rank_normalize(samples):
+    # normal scores of the ranks over all chains, so the diagnostics also work for heavy tails
+    ranks = stats.rankdata(samples, axis=None).reshape(np.shape(samples))
+    return special.ndtri((ranks - 0.375) / (np.size(samples) + 0.25))
+
+
+def gelman_rubin(samples):
+    # Rank-normalized split R-hat (Vehtari et al. 2021) for samples of shape (n_points, n_chains): the larger
+    # of the values for the bulk (the rank-normalized samples) and the tails (the folded samples |x - median|)
+    samples = np.asarray(samples, dtype=float)
+    if samples.shape[0] < 4:
+        return np.nan
+    folded = np.abs(samples - np.median(samples))
+    return np.max([classic_gelman_rubin(rank_normalize(split_chains(samples))),
+                   classic_gelman_rubin(rank_normalize(split_chains(folded)))])
+
+
+def classic_gelman_rubin(samples):
+    # Gelman-Rubin potential scale reduction for samples of shape (n_points, n_chains)
+    n_points = samples.shape[0]
+    if n_points < 2 or samples.shape[1] < 2:
+        return np.nan
+    within = np.mean(np.var(samples, axis=0, ddof=1))
+    between = n_points * np.var(np.mean(samples, axis=0), ddof=1)
+    if within == 0.:
+        return np.nan
+    var_plus = (n_points - 1) / n_points * within + between / n_points
+    return np.sqrt(var_plus / within)
+
+
+def effective_sample_size(samples):
+    # effective sample size for samples of shape (n_points, n_chains), from the autocorrelation
+    # averaged over chains and summed with Geyer's initial monotone sequence
+    samples = np.asarray(samples, dtype=float)
+    if samples.ndim == 1:
+        samples = samples.reshape(-1, 1)
+    n_points, n_chains = samples.shape
+    if n_points < 4:
+        return np.nan
+
+    centered = samples - np.mean(samples, axis=0)
+    transform = np.fft.rfft(centered, n=2 * n_points, axis=0)
+    autocovariance = np.fft.irfft(transform * np.conj(transform), axis=0)[:n_points] / n_points
+    within = np.mean(autocovariance[0]) * n_points / (n_points - 1)
+    var_plus = within * (n_points - 1) / n_points
+    if n_chains > 1:
+        var_plus += np.var(np.mean(samples, axis=0), ddof=1)
+    if var_plus == 0.:
+        return np.nan
+    rho = 1. - (within - np.mean(autocovariance, axis=1)) / var_plus
+    rho[0] = 1.
+
+    pair_sums = rho[:n_points - 1:2] + rho[1:n_points:2]
+    n_positive = np.argmax(pair_sums < 0.) if np.any(pair_sums < 0.) else len(pair_sums)
+    pair_sums = np.minimum.accumulate(pair_sums[:n_positive])
+    tau = max(-1. + 2. * np.sum(pair_sums), 1. / np.log10(n_points * n_chains))
+    return n_points * n_chains / tau
@@ -1,18 +1,61 @@
 # A RadiationCounter accepts a RadiationSource and counts the number of decays over a fixed period of time
-import pickle
+#
+# SimulatedRadiationCounter.produce_counts draws many pseudo-experiments at once, broadcasting over
+# arrays of activity, efficiency and background, with a seedable np.random.Generator:
+# counts = sim_detector.produce_counts(1000000, activity=np.linspace(0., 1., 101))  # shape (1000000, 101)
+#
+# get_log_likelihood works in log space and broadcasts over counts and parameter grids, and
+# joint_log_likelihood adds several counters (e.g. calibration, control and signal runs):
+# a, b, eps = np.meshgrid(a_values, b_values, eps_values, indexing='ij')
+# log_lik = joint_log_likelihood([(sim_detector, observed, {'activity': a, 'efficiency': eps, 'background': b}),
+#                                 (sim_control_detector, observed_control, {'background': b}),
+#                                 (sim_calib_detector, observed_calib, {'efficiency': eps, 'background': b})])
+#
+# get_neg_log_likelihood_and_gradient gives -log L with its analytic gradient with respect to PARAMETER_NAMES,
+# used by trisep.CostFunction.CounterCost to give Minuit the gradient.
+#
+# count = await counter.acquire() does the same as start() and get_count() without blocking the
+# interpreter while waiting (see trisep.AcquisitionScheduler to run several instruments at once).
 import time
 
-from scipy import stats
+import numpy as np
+from scipy import special, stats
 
 from trisep.RadioactiveSource import RadioactiveSource
+from trisep.AcquisitionScheduler import wait_counting_time
+from trisep.TrisepConstants import get_constants
+
+# order of the parameters in the gradients of SimulatedRadiationCounter
+PARAMETER_NAMES = ['activity', 'efficiency', 'background']
+
+# log(k!) for k = 0, 1, ..., 4095 (larger counts use special.gammaln, so the table stays small)
+log_factorial_table = special.gammaln(np.arange(4096) + 1.)
+
+
+def log_factorial(counts):
+    # log(k!), or +inf where counts is negative or not an integer, so that the likelihood is 0 there
+    # (log L = -inf, as for stats.poisson.logpmf)
+    counts = np.asarray(counts)
+    valid = (counts >= 0) & (counts == np.floor(counts))
+    values = np.where(valid, counts, 0)
+    large = values >= len(log_factorial_table)
+    result = log_factorial_table[np.where(large, 0, values).astype(int)]
+    if np.any(large):
+        result = np.where(large, special.gammaln(values + 1.), result)
+    return np.where(valid, result, np.inf)
+
+
+def joint_log_likelihood(terms):
+    # sum of log likelihoods for a list of (counter, counts, parameters) terms, where parameters
+    # is a dict of activity/efficiency/background values or arrays passed to get_log_likelihood
+    return sum(counter.get_log_likelihood(counts, **parameters) for counter, counts, parameters in terms)
 
 
 class RadiationCounter:
     def __init__(self, bypass_wait=False):
         self.counting_time = 10.
         self.bypass_wait = bypass_wait
-        with open('trisep.p', 'rb') as f:
-            TC = pickle.load(f)
+        TC = get_constants()
         self.max_calibration_source_activity = TC.max_calibration_source_activity
         self.lab_source = RadioactiveSource(TC.source_activity)
         self.source = None
@@ -53,6 +96,14 @@ class RadiationCounter:
             time.sleep(self.counting_time)
         self.produce_count(verbose=True)
 
+    async def acquire(self, progress=None, clock=None, interval=0.5):
+        # start() without blocking: progress(elapsed, counting_time) is called while waiting, and
+        # cancelling the task stops the run without producing a count
+        if not self.bypass_wait:
+            await wait_counting_time(self.counting_time, progress, clock, interval)
+        self.produce_count(verbose=True)
+        return self.count
+
     def produce_count(self, verbose=False):
         # A single Poisson random variable would be faster but
         # the following is written to be more transparent
@@ -78,8 +129,10 @@ class RadiationCounter:
 
 
 class SimulatedRadiationCounter(RadiationCounter):
-    def __init__(self, efficiency=1., background=0.):
+    def __init__(self, efficiency=1., background=0., seed=None):
         self.counting_time = 10.
+        self.bypass_wait = True  # nothing to wait for in a simulation
+        self.rng = np.random.default_rng(seed)
         self.source = None
         self.efficiency = efficiency
         self.background = background
@@ -121,3 +174,84 @@ class SimulatedRadiationCounter(RadiationCounter):
         likelihood = stats.poisson.pmf(count, expected_value)
 
         return likelihood
+
+    def produce_counts(self, n_toys, activity=None, efficiency=None, background=None, exact=False):
+        # Counts for n_toys pseudo-experiments, for each point of the broadcast parameter arrays.
+        # Parameters not given are taken from the inserted source and the detector settings.
+        # Thinning the decays with the efficiency gives a single Poisson random variable for the
+        # total count. exact=True draws the decays, the binomial efficiency and the background separately.
+        if activity is None:
+            activity = 0. if self.source is None else self.source.activity
+        if efficiency is None:
+            efficiency = self.efficiency
+        if background is None:
+            background = self.background
+        activity = np.asarray(activity, dtype=float)
+        efficiency = np.asarray(efficiency, dtype=float)
+        background = np.asarray(background, dtype=float)
+
+        if np.any(activity < 0.):
+            print('Error: source activity must not be negative!')
+            return None
+        if np.any((efficiency < 0.) | (efficiency > 1.)):
+            print('Error: Efficiency must be between 0. and 1.')
+            return None
+        if np.any(background < 0.):
+            print('Error: Background rate cannot be negative')
+            return None
+
+        shape = (n_toys,) + np.broadcast_shapes(activity.shape, efficiency.shape, background.shape)
+        if exact:
+            n_decays = self.rng.poisson(activity * self.counting_time, size=shape)
+            n_signal = self.rng.binomial(n_decays, np.broadcast_to(efficiency, shape))
+            n_background = self.rng.poisson(background * self.counting_time, size=shape)
+            return n_signal + n_background
+
+        expected_value = (activity * efficiency + background) * self.counting_time
+        return self.rng.poisson(expected_value, size=shape)
+
+    def get_log_likelihood(self, counts, activity=None, efficiency=None, background=None):
+        # Poisson log likelihood, broadcast over arrays of counts and parameters.
+        # Parameters not given are taken from the inserted source and the detector settings.
+        if activity is None:
+            activity = 0. if self.source is None else self.source.activity
+        if efficiency is None:
+            efficiency = self.efficiency
+        if background is None:
+            background = self.background
+        counts = np.asarray(counts)
+        expected_value = (np.asarray(activity) * efficiency + background) * self.counting_time
+        log_k_factorial = log_factorial(counts)
+        with np.errstate(invalid='ignore'):
+            log_likelihood = special.xlogy(counts, expected_value) - expected_value - log_k_factorial
+        log_likelihood = np.where(np.isinf(log_k_factorial), -np.inf, log_likelihood)
+        if np.ndim(log_likelihood) == 0:
+            return float(log_likelihood)
+        return log_likelihood
+
+    def get_neg_log_likelihood_and_gradient(self, counts, activity=None, efficiency=None, background=None):
+        # -log L as get_log_likelihood, and its gradient with respect to PARAMETER_NAMES,
+        # of shape (3,) + the broadcast shape of counts and parameters
+        if activity is None:
+            activity = 0. if self.source is None else self.source.activity
+        if efficiency is None:
+            efficiency = self.efficiency
+        if background is None:
+            background = self.background
+        counts = np.asarray(counts)
+        activity = np.asarray(activity, dtype=float)
+        efficiency = np.asarray(efficiency, dtype=float)
+        expected_value = (activity * efficiency + background) * self.counting_time
+        log_k_factorial = log_factorial(counts)
+        with np.errstate(invalid='ignore'):
+            neg_log_likelihood = expected_value - special.xlogy(counts, expected_value) + log_k_factorial
+        neg_log_likelihood = np.where(np.isinf(log_k_factorial), np.inf, neg_log_likelihood)
+
+        # d(-log L)/d mu = 1 - k/mu, then the chain rule through mu = (a*eps + b)*t
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d_expected = 1. - np.where(counts > 0, counts / expected_value, 0.)
+            gradient = self.counting_time * d_expected * np.array(np.broadcast_arrays(efficiency, activity,
+                                                                                      np.ones_like(d_expected)))
+        if np.ndim(neg_log_likelihood) == 0:
+            return float(neg_log_likelihood), gradient
+        return neg_log_likelihood, gradient
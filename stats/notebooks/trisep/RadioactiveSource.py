@@ -1,14 +1,13 @@
 # A RadioactiveSource contains unstable isotopes
-import pickle
-
 from scipy import stats
 
+from trisep.TrisepConstants import get_constants
+
 
 class RadioactiveSource:
     def __init__(self, activity):
         self.activity = None
-        with open('trisep.p', 'rb') as f:
-            TC = pickle.load(f)
+        TC = get_constants()
         self.max_calibration_source_activity = TC.max_calibration_source_activity
         self.set_activity(activity)
 
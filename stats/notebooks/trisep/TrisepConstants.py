@@ -1,4 +1,15 @@
 # Constants used to define real devices
+#
+# The constants for the lab devices are read once per process from trisep.p, found next to the trisep
+# package (not in the current working directory), the first time get_constants() is called.
+# set_constants() injects a TrisepConstants object, or selects another pickle file to read lazily.
+import os
+import pickle
+import threading
+
+constants_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'trisep.p')
+constants = None
+constants_lock = threading.Lock()
 
 
 class TrisepConstants:
@@ -12,3 +23,23 @@ class TrisepConstants:
         self.le_time_resolution = None
         self.le_time_offset = None
         self.le_background_fraction = None
+
+
+def get_constants():
+    global constants
+    if constants is None:
+        with constants_lock:
+            # check again: another thread may have loaded the file while we waited for the lock
+            if constants is None:
+                with open(constants_path, 'rb') as f:
+                    constants = pickle.load(f)
+    return constants
+
+
+def set_constants(trisep_constants=None, path=None):
+    # inject the constants directly, or give the path of a pickle file to be read on next use
+    global constants, constants_path
+    with constants_lock:
+        if path is not None:
+            constants_path = path
+        constants = trisep_constants
@@ -1 +1 @@
-from trisep.TrisepConstants import TrisepConstants
+from trisep.TrisepConstants import TrisepConstants, get_constants, set_constants